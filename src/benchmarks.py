@@ -0,0 +1,999 @@
+# Benchmarks and demos for the helpers in toolkit.py. Every benchmark runs
+# against local mock servers, so no API key or network access is needed.
+#
+#   python benchmarks.py                  run every benchmark
+#   python benchmarks.py NAME [NAME ...]  run the named benchmarks
+#   python benchmarks.py --list           list the benchmark names
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import numpy as np
+import requests
+from openai import OpenAI
+from openai.types.chat.chat_completion_message_tool_call import (
+    ChatCompletionMessageToolCall,
+    Function,
+)
+from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+from common import airport_tools, build_review_messages, review_tools
+from mock_server import start_mock_server
+from toolkit import (
+    AdaptiveLimit,
+    AirportCache,
+    Cassette,
+    CassetteTransport,
+    CircuitBreaker,
+    Conversation,
+    ConversationStore,
+    HedgePolicy,
+    LatencyHistogram,
+    ModelRouter,
+    ModerationGate,
+    NumpyIndex,
+    PromptBuilder,
+    RateLimiter,
+    ResponseCache,
+    SemanticCache,
+    Telemetry,
+    UpstreamGuard,
+    UpstreamUnavailable,
+    ValidationError,
+    cached_chat_completion,
+    cached_prompt_tokens,
+    canonical_json,
+    classify_packed,
+    compile_schema,
+    complete_with_tools,
+    count_chat_tokens,
+    extract_from_long_text,
+    fetch_airport_info,
+    get_http_session,
+    get_openai_client,
+    get_response_async,
+    get_response_hedged,
+    get_response_limited,
+    get_structured_response,
+    get_tool_validators,
+    get_validated_arguments,
+    guarded_airport_info,
+    guarded_get_response,
+    guarded_moderation,
+    loads_json,
+    moderated_completion,
+    new_async_openai_client,
+    parse_tool_arguments,
+    register_tool,
+    run_batch_pipeline,
+    stream_response,
+    telemetry,
+    truncate_messages,
+    upstream_retrying,
+)
+
+jfk_messages = [
+    {
+        "role": "system",
+        "content": "You are an AI assistant, an aviation specialist. You should interpret the user prompt, and based on it extract an airport code corresponding to their message.",
+    },
+    {
+        "role": "user",
+        "content": "I'm planning to land a plane in JFK airport in New York and would like to have the corresponding information.",
+    },
+]
+reviews = [
+    "I recently purchased the TechCorp ProMax and I'm absolutely in love with its powerful processor. However, I think they could really improve the product by deciding to offer more color options.",
+    "Thrilled with the quality, but I think it should come with a wider choice of screen sizes.",
+    "I recently purchased the steel color version of the thermal mug and I am absolutely thrilled with it!",
+]
+review_messages = build_review_messages(
+    "\nI recently purchased the TechCorp ProMax and I'm absolutely in love with its powerful processor. However, I think they could really improve the product by deciding to offer more color options.\n"
+)
+reply_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "reply_to_review",
+            "description": "Reply politely to the customer who wrote the review",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "reply": {
+                        "type": "string",
+                        "description": "Reply to post in response to the review",
+                    }
+                },
+            },
+        },
+    }
+]
+paper_text = (
+    "A. M. Turing (1950) Computing Machinery and Intelligence. Mind 49: 433-460.\n"
+    + 'I propose to consider the question, "Can machines think?" ' * 400
+)
+paper_messages = [
+    {
+        "role": "system",
+        "content": "Don't make assumptions about what values to plug into functions. Ask for clarification if a user request is ambiguous.",
+    },
+    {"role": "user", "content": paper_text},
+]
+paper_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "extract_review_info",
+            "description": "Extract the title and year of publication from research papers.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "title": {
+                        "type": "string",
+                        "description": "Title of the research paper",
+                    },
+                    "year": {
+                        "type": "string",
+                        "description": "Year of publication of the research paper",
+                    },
+                },
+            },
+        },
+    }
+]
+aviation_prompt = "You are an AI assistant, an aviation specialist. You should interpret the user prompt, and based on it extract an airport code corresponding to their message."
+assumptions_prompt = "Don't make assumptions about what values to plug into functions."
+airport_questions = [
+    "I'm planning to land a plane in JFK airport in New York and would like to have the corresponding information.",
+    "What can you tell me about Los Angeles International Airport?",
+    "I need the details of San Francisco airport before my flight.",
+]
+rome_prompt = "Your role is to assess whether the user question is allowed or not, and if it is, to be a helpful assistant to tourists visiting Rome. The allowed topics are food and drink, attractions, history and things to do around the city of Rome. If the topic is allowed, reply with an answer as normal, otherwise say 'Apologies, but I am not allowed to discuss this topic.'"
+
+benchmarks = {}
+
+
+def register_benchmark(name):
+    def register(func):
+        benchmarks[name] = func
+        return func
+
+    return register
+
+
+@contextlib.contextmanager
+def mock_server(**params):
+    server, base_url = start_mock_server(**params)
+    try:
+        yield server, base_url
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+async def benchmark_concurrency(base_url, num_requests=40):
+    client = new_async_openai_client(api_key="mock", base_url=base_url)
+    message_lists = [
+        [{"role": "user", "content": f"List holiday destination number {i}."}]
+        for i in range(num_requests)
+    ]
+    for max_concurrency in [1, 4, 16]:
+        start = time.perf_counter()
+        async for index, content in get_response_async(
+            message_lists, max_concurrency=max_concurrency, client=client
+        ):
+            pass
+        elapsed = time.perf_counter() - start
+        print(
+            f"max_concurrency={max_concurrency}: {num_requests / elapsed:.1f} requests/s"
+        )
+
+
+@register_benchmark("concurrency")
+def run_concurrency():
+    # 50 ms of simulated latency per request
+    with mock_server(latency=0.05) as (server, base_url):
+        asyncio.run(benchmark_concurrency(base_url))
+
+
+@register_benchmark("rate-limit")
+def run_rate_limit():
+    # Admit at most 5 requests per second against the local mock server
+    rate_limiter = RateLimiter(
+        requests_per_minute=300, tokens_per_minute=200000, burst_seconds=1
+    )
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        start = time.perf_counter()
+        for i in range(15):
+            get_response_limited(
+                [{"role": "user", "content": f"List holiday destination number {i}."}],
+                rate_limiter,
+                client=mock_client,
+            )
+    print(f"15 rate-limited requests took {time.perf_counter() - start:.1f}s")
+
+
+@register_benchmark("response-cache")
+def run_response_cache():
+    # A fresh file each run, so the first call is always a miss
+    response_cache = ResponseCache(
+        os.path.join(tempfile.mkdtemp(), "response_cache.sqlite")
+    )
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        for attempt in ["first", "second"]:
+            start = time.perf_counter()
+            cached_chat_completion(
+                response_cache,
+                client=mock_client,
+                model="gpt-3.5-turbo",
+                messages=jfk_messages,
+            )
+            print(f"{attempt} call: {(time.perf_counter() - start) * 1e6:.0f} µs")
+    print(response_cache.stats())
+
+
+def benchmark_pooling(base_url, num_calls=50):
+    messages = [{"role": "user", "content": "List ten holiday destinations."}]
+    airport_url = base_url.removesuffix("/v1") + "/v1/airports"
+    timings = {}
+    start = time.perf_counter()
+    for i in range(num_calls):
+        OpenAI(api_key="mock", base_url=base_url).chat.completions.create(
+            model="gpt-3.5-turbo", messages=messages
+        )
+    timings["fresh OpenAI() per call"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(num_calls):
+        get_openai_client(base_url=base_url, api_key="mock").chat.completions.create(
+            model="gpt-3.5-turbo", messages=messages
+        )
+    timings["pooled OpenAI client"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(num_calls):
+        requests.request("GET", airport_url, params={"apt": "JFK"})
+    timings["requests.request per call"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for i in range(num_calls):
+        get_http_session().get(airport_url, params={"apt": "JFK"})
+    timings["pooled requests session"] = time.perf_counter() - start
+    for name, elapsed in timings.items():
+        print(f"{name}: {elapsed / num_calls * 1000:.2f} ms/call")
+
+
+@register_benchmark("pooling")
+def run_pooling():
+    # Zero simulated latency so only connection and client setup costs remain
+    with mock_server(latency=0) as (server, base_url):
+        benchmark_pooling(base_url)
+
+
+def build_batch_messages(review):
+    return [
+        {"role": "system", "content": "Extract the product and sentiment."},
+        {"role": "user", "content": review},
+    ]
+
+
+@register_benchmark("batch")
+def run_batch():
+    with mock_server(latency=0.05) as (server, base_url):
+        batch_client = get_openai_client(base_url=base_url, api_key="mock")
+        # The Batch API reports review-1 as failed, without losing the others
+        server.failed_custom_ids = {"review-1"}
+        errors = {}
+        for custom_id, body, response, error in run_batch_pipeline(
+            ((f"review-{i}", review) for i, review in enumerate(reviews)),
+            build_batch_messages,
+            workdir=tempfile.mkdtemp(),
+            poll_interval=0.1,
+            client=batch_client,
+        ):
+            print(custom_id, error or response.choices[0].message.content)
+            errors[custom_id] = error
+    assert len(errors) == len(reviews)
+    assert [custom_id for custom_id, error in errors.items() if error] == ["review-1"]
+
+
+@register_benchmark("streaming")
+def run_streaming():
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        for kind, payload in stream_response(
+            review_messages, client=mock_client, tools=review_tools
+        ):
+            print(kind, payload)
+
+
+@register_benchmark("long-text")
+def run_long_text():
+    truncated_messages = truncate_messages(paper_messages, 1000, tools=paper_tools)
+    print(count_chat_tokens(truncated_messages, tools=paper_tools))
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        print(extract_from_long_text(paper_messages, paper_tools, client=mock_client))
+
+
+@register_tool(timeout=5)
+def extract_sentiment_and_product_features(
+    product=None, sentiment=None, features=None, suggestions=None
+):
+    time.sleep(0.2)
+    return {"saved": True, "product": product, "sentiment": sentiment}
+
+
+@register_tool(timeout=5)
+async def reply_to_review(reply):
+    await asyncio.sleep(0.2)
+    return {"posted": True, "reply": reply}
+
+
+@register_benchmark("tools")
+def run_tools():
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        airport_cache = AirportCache(url=base_url + "/airports")
+        register_tool("get_airport_info", timeout=10)(airport_cache.get_airport_info)
+        # Both 0.2 s tools run side by side, so the turn takes about 0.2 s of tool time
+        start = time.perf_counter()
+        response = complete_with_tools(
+            review_messages, review_tools + reply_tools, client=mock_client
+        )
+        print(
+            f"{time.perf_counter() - start:.2f}s", response.choices[0].message.content
+        )
+
+
+@register_benchmark("airport-cache")
+def run_airport_cache():
+    # Verify coalescing and bulk lookups against the local aviation API stub
+    with mock_server(latency=0.1) as (airport_stub, airport_stub_url):
+        stub_cache = AirportCache(url=airport_stub_url + "/airports")
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            list(executor.map(stub_cache.get_airport_info, ["JFK"] * 20))
+        print(
+            f"20 concurrent JFK lookups: {airport_stub.request_count} upstream request"
+        )
+        assert airport_stub.request_count == 1
+        # JFK is cached, so LAX and SFO share one bulk request
+        stub_cache.get_many(["JFK", "LAX", "SFO"])
+        print(
+            f"after bulk JFK/LAX/SFO lookup: {airport_stub.request_count} upstream requests"
+        )
+        assert airport_stub.request_count == 2
+
+
+@register_benchmark("moderation")
+def run_moderation():
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        moderation_gate = ModerationGate(client=mock_client)
+        print(
+            [
+                result.flagged
+                for result in moderation_gate.moderate_many(
+                    [
+                        "Can you show some example sentences in the past tense in French?",
+                        "How do I kill a process that is not responding?",
+                    ]
+                )
+            ]
+        )
+        tourist_questions = [
+            "Can you recommend a good restaurant in Rome?",
+            "What are the best museums to visit in Rome?",
+        ]
+        for speculative, question in zip([False, True], tourist_questions):
+            start = time.perf_counter()
+            moderated_completion(
+                [{"role": "user", "content": question}],
+                moderation_gate,
+                speculative=speculative,
+                client=mock_client,
+            )
+            print(f"speculative={speculative}: {time.perf_counter() - start:.3f}s")
+
+
+@register_benchmark("validation")
+def run_validation():
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        print(get_validated_arguments(jfk_messages, airport_tools, client=mock_client))
+
+    # Measure parse and validation cost per call
+    review_arguments = json.dumps(
+        {
+            "product": "TechCorp ProMax",
+            "sentiment": "positive",
+            "features": ["powerful processor"],
+            "suggestions": ["more color options"],
+        }
+    )
+    review_validator = compile_schema(review_tools[0]["function"]["parameters"])
+    num_calls = 100000
+    start = time.perf_counter()
+    for i in range(num_calls):
+        review_validator(loads_json(review_arguments))
+    elapsed = time.perf_counter() - start
+    print(f"parse and validate: {elapsed / num_calls * 1e6:.2f} µs/call")
+
+    # The same work through parse_tool_arguments, with the validators built once
+    tool_call = ChatCompletionMessageToolCall(
+        id="call_0",
+        type="function",
+        function=Function(
+            name="extract_sentiment_and_product_features", arguments=review_arguments
+        ),
+    )
+    validators = get_tool_validators(review_tools)
+    start = time.perf_counter()
+    for i in range(num_calls):
+        parse_tool_arguments(tool_call, review_tools, validators)
+    elapsed = time.perf_counter() - start
+    print(f"parse_tool_arguments: {elapsed / num_calls * 1e6:.2f} µs/call")
+
+
+@dataclasses.dataclass(slots=True)
+class Book:
+    title: str
+    author: str
+
+
+@dataclasses.dataclass(slots=True)
+class Company:
+    name: str
+    address: str
+
+
+book_schema = {
+    "type": "object",
+    "properties": {
+        "books": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "author": {"type": "string"},
+                },
+                "required": ["title", "author"],
+            },
+        }
+    },
+    "required": ["books"],
+}
+company_schema = {
+    "type": "object",
+    "properties": {
+        "companies": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "address": {"type": "string"},
+                },
+                "required": ["name", "address"],
+            },
+        }
+    },
+    "required": ["companies"],
+}
+
+
+@register_benchmark("structured-output")
+def run_structured_output():
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        print(
+            get_structured_response(
+                [
+                    {
+                        "role": "user",
+                        "content": "I have these notes with book titles and authors: New releases this week! The Beholders by Hester Musson, The Mystery Guest by Nita Prose. Please organize the titles and authors in a json file.",
+                    }
+                ],
+                book_schema,
+                {"books": Book},
+                client=mock_client,
+            )
+        )
+        print(
+            get_structured_response(
+                [
+                    {
+                        "role": "user",
+                        "content": "Here are some made-up addresses and company names, write them in json format. PurpleLabs Solutions, 123 Main Street, Suite 100, Anytown, USA. InnovateNow Enterprises, 789 Oak Avenue, Suite 300, Innovation City, USA. PeakPerformance Inc., 456 Elm Street, Suite 200, Dreamville, USA",
+                    }
+                ],
+                company_schema,
+                {"companies": Company},
+                client=mock_client,
+            )
+        )
+
+
+@register_benchmark("telemetry")
+def run_telemetry():
+    # Measure the bookkeeping cost of one tracked call
+    overhead_telemetry = Telemetry()
+    num_calls = 100000
+    start = time.perf_counter()
+    for i in range(num_calls):
+        with overhead_telemetry.track("overhead_check"):
+            pass
+    elapsed = time.perf_counter() - start
+    print(f"telemetry overhead: {elapsed / num_calls * 1e6:.2f} µs/call")
+
+    # Export everything recorded so far in Prometheus text format
+    print(telemetry.export_prometheus())
+
+
+def run_benchmark(name, flow, num_calls=100, concurrency=8):
+    histogram = LatencyHistogram()
+    errors = 0
+
+    def timed_call(i):
+        start = time.perf_counter()
+        try:
+            flow()
+            failed = False
+        except Exception:
+            failed = True
+        return time.perf_counter() - start, failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for elapsed, failed in executor.map(timed_call, range(num_calls)):
+            histogram.record(elapsed)
+            errors += failed
+    wall_time = time.perf_counter() - start
+    # Measure peak memory in a short separate pass so tracing does not skew timings
+    tracemalloc.start()
+    for i in range(min(num_calls, 10)):
+        timed_call(i)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(
+        f"{name:<18} {num_calls / wall_time:8.1f} calls/s"
+        f"  p50={histogram.percentile(0.5) * 1000:7.1f} ms"
+        f"  p95={histogram.percentile(0.95) * 1000:7.1f} ms"
+        f"  p99={histogram.percentile(0.99) * 1000:7.1f} ms"
+        f"  errors={errors:3d}  peak={peak_memory / 1024:8.1f} KiB"
+    )
+
+
+def benchmark_flows(base_url, num_calls=100, concurrency=8):
+    client = get_openai_client(base_url=base_url, api_key="mock")
+    no_retry_client = client.with_options(max_retries=0)
+    airport_url = base_url + "/airports"
+    input_message = {
+        "role": "user",
+        "content": "I'd like to buy a shirt and a jacket. Can you suggest two color pairings for these items?",
+    }
+
+    def json_mode():
+        client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": "Organize these books as json."}],
+            response_format={"type": "json_object"},
+        )
+
+    # The course's retry policy, scaled down so the benchmark finishes quickly
+    @retry(
+        wait=wait_random_exponential(min=0.005, max=0.04), stop=stop_after_attempt(4)
+    )
+    def retry_wrapper():
+        no_retry_client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": "List ten holiday destinations."}],
+        )
+
+    def token_guard():
+        if count_chat_tokens([input_message]) <= 100:
+            client.chat.completions.create(
+                model="gpt-3.5-turbo", messages=[input_message]
+            )
+
+    def function_calling():
+        response = client.chat.completions.create(
+            model="gpt-3.5-turbo", messages=review_messages, tools=review_tools
+        )
+        for tool_call in response.choices[0].message.tool_calls:
+            json.loads(tool_call.function.arguments)
+
+    def airport_lookup():
+        response = client.chat.completions.create(
+            model="gpt-3.5-turbo", messages=jfk_messages, tools=airport_tools
+        )
+        function_call = response.choices[0].message.tool_calls[0].function
+        code = json.loads(function_call.arguments)["airport_code"]
+        fetch_airport_info(code, url=airport_url)
+
+    for name, flow in [
+        ("json_mode", json_mode),
+        ("retry_wrapper", retry_wrapper),
+        ("token_guard", token_guard),
+        ("function_calling", function_calling),
+        ("airport_lookup", airport_lookup),
+    ]:
+        run_benchmark(name, flow, num_calls, concurrency)
+
+
+@register_benchmark("flows")
+def run_flows():
+    # 20 ms +/- 10 ms latency with 5% 429s and 2% server errors
+    with mock_server(
+        latency=0.02, jitter=0.01, error_rate=0.02, rate_limit_rate=0.05, seed=42
+    ) as (server, base_url):
+        benchmark_flows(base_url)
+
+
+@register_benchmark("prompt-caching")
+def run_prompt_caching():
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        # The original layout appends a system message after the user message
+        for question in airport_questions:
+            response = mock_client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": aviation_prompt},
+                    {"role": "user", "content": question},
+                    {"role": "system", "content": assumptions_prompt},
+                ],
+                tools=airport_tools,
+            )
+            print("original layout cached tokens:", cached_prompt_tokens(response))
+
+        airport_prompt_builder = PromptBuilder(
+            [aviation_prompt, assumptions_prompt], tools=airport_tools
+        )
+        for question in airport_questions:
+            airport_prompt_builder.create(
+                [{"role": "user", "content": question}], client=mock_client
+            )
+        print(airport_prompt_builder.cache_report())
+
+
+strict_paper_tools = canonical_json(paper_tools)
+strict_paper_tools[0]["function"]["parameters"]["required"] = ["title", "year"]
+
+
+def validate_review_info(response):
+    for tool_call in response.choices[0].message.tool_calls or []:
+        arguments = parse_tool_arguments(tool_call, strict_paper_tools)
+        if not arguments["year"].isdigit():
+            raise ValidationError(f"year {arguments['year']!r} is not a number")
+
+
+@register_benchmark("routing")
+def run_routing():
+    model_router = ModelRouter()
+    truncated_messages = truncate_messages(paper_messages, 1000, tools=paper_tools)
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        # The mock never returns a numeric year, so every tier is tried in turn
+        try:
+            model_router.route(
+                "extraction",
+                truncated_messages,
+                validate=validate_review_info,
+                client=mock_client,
+                tools=strict_paper_tools,
+            )
+        except ValidationError as e:
+            print("all models failed validation:", e)
+    for decision in model_router.decisions:
+        print(decision)
+
+    # Routing overhead, including the token count of the request
+    num_calls = 1000
+    start = time.perf_counter()
+    for i in range(num_calls):
+        model_router.choose("extraction", count_chat_tokens(review_messages))
+    elapsed = time.perf_counter() - start
+    print(f"routing overhead: {elapsed / num_calls * 1000:.3f} ms/decision")
+
+
+async def benchmark_hedging(base_url, num_requests=300, concurrency=4):
+    client = new_async_openai_client(api_key="mock", base_url=base_url)
+    semaphore = asyncio.Semaphore(concurrency)
+    messages = [{"role": "user", "content": "List ten holiday destinations."}]
+    for name, policy in [
+        ("no hedging", HedgePolicy(max_hedge_ratio=0)),
+        ("hedging", HedgePolicy(percentile=0.9, max_hedge_ratio=0.1)),
+    ]:
+        histogram = LatencyHistogram()
+
+        async def timed_request():
+            async with semaphore:
+                start = time.perf_counter()
+                await get_response_hedged(messages, policy, timeout=5, client=client)
+                histogram.record(time.perf_counter() - start)
+
+        await asyncio.gather(*(timed_request() for i in range(num_requests)))
+        print(
+            f"{name:<11} p50={histogram.percentile(0.5) * 1000:6.1f} ms"
+            f"  p99={histogram.percentile(0.99) * 1000:6.1f} ms"
+            f"  hedges={policy.hedges}/{policy.requests}"
+        )
+
+
+@register_benchmark("hedging")
+def run_hedging():
+    # 5% of requests take an extra 500 ms
+    with mock_server(
+        latency=0.05, jitter=0.01, tail_rate=0.05, tail_latency=0.5, seed=7
+    ) as (server, base_url):
+        asyncio.run(benchmark_hedging(base_url))
+
+
+@register_benchmark("conversations")
+def run_conversations():
+    conversation_store = ConversationStore(
+        os.path.join(tempfile.mkdtemp(), "conversations.sqlite")
+    )
+    session_id = str(uuid.uuid4())
+    conversation = Conversation(
+        session_id,
+        "You are a personal finance assistant.",
+        conversation_store,
+        token_budget=120,
+        keep_recent=2,
+    )
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        for question in [
+            "How can I make a plan to save $800 for a trip?",
+            "How long would that take if I save $50 a week?",
+            "What if I also cut my coffee budget by $10 a week?",
+            "Which of these steps should I start with?",
+        ]:
+            conversation.send(question, client=mock_client)
+            print(f"{len(conversation.turns)} turns, {conversation.token_count} tokens")
+
+    # A new worker process can pick the session up from the store
+    resumed = Conversation(
+        session_id, "You are a personal finance assistant.", conversation_store
+    )
+    print(resumed.token_count == conversation.token_count, resumed.turns[0]["role"])
+
+
+@register_benchmark("semantic-cache")
+def run_semantic_cache():
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        semantic_cache = SemanticCache(threshold=0.9, client=mock_client)
+        for question in [
+            "Can you recommend a good restaurant in Rome?",
+            "Can you recommend a good restaurant in Rome, please?",
+            "What are the best museums to visit in Rome?",
+        ]:
+            semantic_cache.get_response(
+                [
+                    {"role": "system", "content": rome_prompt},
+                    {"role": "user", "content": question},
+                ],
+                client=mock_client,
+            )
+    print({"hits": semantic_cache.hits, "misses": semantic_cache.misses})
+
+    # Lookup latency grows linearly with the size of the brute-force index
+    rng = np.random.default_rng(0)
+    for size in [1000, 10000, 50000]:
+        index = NumpyIndex(256, size)
+        vectors = rng.standard_normal((size, 256)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index.vectors[:] = vectors
+        index.used[:] = True
+        start = time.perf_counter()
+        for i in range(100):
+            index.search(vectors[i])
+        elapsed = time.perf_counter() - start
+        print(f"index size {size:6d}: {elapsed / 100 * 1e6:8.1f} µs/lookup")
+
+
+@register_benchmark("packing")
+def run_packing():
+    rome_questions = [
+        "Can you recommend a good restaurant in Rome?",
+        "What are the best museums to visit in Rome?",
+        "Which stocks should I buy this year?",
+        "How old is the Colosseum?",
+        "Can you help me write a cover letter?",
+    ] * 20
+    allowed_schema = {
+        "properties": {
+            "allowed": {
+                "type": "boolean",
+                "description": "Whether the question is about food and drink, attractions, history or things to do around the city of Rome",
+            }
+        },
+        "required": ["allowed"],
+    }
+    with mock_server(latency=0.05) as (server, base_url):
+        mock_client = get_openai_client(base_url=base_url, api_key="mock")
+        for max_items in [1, 20]:
+            requests_before = server.request_count
+            start = time.perf_counter()
+            results = classify_packed(
+                rome_questions,
+                "Assess whether each user question is an allowed topic for a Rome tourist assistant.",
+                allowed_schema,
+                max_items=max_items,
+                client=mock_client,
+            )
+            elapsed = time.perf_counter() - start
+            print(
+                f"max_items={max_items:2d}: {len(results)} results in "
+                f"{server.request_count - requests_before} requests, {elapsed:.2f} s"
+            )
+
+
+@register_benchmark("circuit-breaker")
+def run_circuit_breaker():
+    # Drive all three endpoints through a healthy period, an outage and a recovery.
+    # The demo builds its own guards and a scaled-down retry policy so the shared
+    # production ones are left untouched.
+    guards = {
+        "chat.completions": UpstreamGuard(
+            "chat.completions", breaker=CircuitBreaker(reset_timeout=0.5)
+        ),
+        "moderations": UpstreamGuard(
+            "moderations", breaker=CircuitBreaker(reset_timeout=0.5)
+        ),
+        "aviation": UpstreamGuard(
+            "aviation",
+            breaker=CircuitBreaker(reset_timeout=0.5),
+            limit=AdaptiveLimit(latency_target=1.0),
+        ),
+    }
+    retrying = upstream_retrying.copy(wait=wait_random_exponential(min=0.005, max=0.04))
+    with mock_server(latency=0.01) as (guard_stub, guard_stub_url):
+        guard_client = get_openai_client(base_url=guard_stub_url, api_key="mock")
+
+        def guarded_flow(i):
+            question = airport_questions[i % len(airport_questions)]
+            try:
+                guarded_moderation(
+                    question, client=guard_client, guards=guards, retrying=retrying
+                )
+                guarded_get_response(
+                    [{"role": "user", "content": question}],
+                    client=guard_client,
+                    guards=guards,
+                    retrying=retrying,
+                )
+                guarded_airport_info(
+                    ["JFK", "LAX", "SFO"][i % 3],
+                    url=guard_stub_url + "/airports",
+                    guards=guards,
+                    retrying=retrying,
+                )
+                return "ok"
+            except UpstreamUnavailable:
+                return "unavailable"
+            except Exception:
+                return "error"
+
+        for phase, outage in [
+            ("healthy", False),
+            ("outage", True),
+            ("recovered", False),
+        ]:
+            guard_stub.outage = outage
+            if phase == "recovered":
+                time.sleep(0.5)
+            requests_before = guard_stub.request_count
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                outcomes = Counter(executor.map(guarded_flow, range(60)))
+            print(
+                f"{phase:9s}: {dict(outcomes)}, "
+                f"{guard_stub.request_count - requests_before} upstream requests"
+            )
+            # Every flow succeeds in each phase, from fallbacks during the outage
+            assert outcomes == {"ok": 60}, outcomes
+    for name, guard in guards.items():
+        print(
+            f"{name}: {guard.breaker.state}, limit {guard.limit.limit:.1f}, "
+            f"{dict(guard.counts)}"
+        )
+        assert guard.counts["fallbacks"] > 0
+        assert guard.breaker.state == "closed"
+
+
+def run_scenarios(client, session, base_url):
+    results = []
+    for question in airport_questions:
+        response = client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[jfk_messages[0], {"role": "user", "content": question}],
+            tools=airport_tools,
+        )
+        results.append(response.choices[0].message.tool_calls[0].function.arguments)
+    stream = client.chat.completions.create(
+        model="gpt-3.5-turbo", messages=review_messages, stream=True
+    )
+    results.append("".join(chunk.choices[0].delta.content or "" for chunk in stream))
+    response = session.get(base_url + "/airports", params={"apt": "JFK"}, timeout=10)
+    results.append(response.json())
+    return results
+
+
+@register_benchmark("cassette")
+def run_cassette():
+    cassette_path = os.path.join(tempfile.mkdtemp(), "scenarios.json.gz")
+
+    # Record once against the stub, then replay with the stub shut down
+    recorder = Cassette(cassette_path, mode="record")
+    with mock_server(latency=0.05) as (cassette_stub, cassette_stub_url):
+        start = time.perf_counter()
+        recorded = run_scenarios(
+            get_openai_client(
+                base_url=cassette_stub_url, api_key="mock", cassette=recorder
+            ),
+            get_http_session(cassette=recorder),
+            cassette_stub_url,
+        )
+        print(f"recorded in {time.perf_counter() - start:.2f} s")
+    recorder.save()
+
+    player = Cassette(cassette_path, mode="replay")
+    replay_client = get_openai_client(
+        base_url=cassette_stub_url, api_key="mock", cassette=player
+    )
+    replay_session = get_http_session(cassette=player)
+    print(run_scenarios(replay_client, replay_session, cassette_stub_url) == recorded)
+    start = time.perf_counter()
+    for i in range(200):
+        run_scenarios(replay_client, replay_session, cassette_stub_url)
+    elapsed = time.perf_counter() - start
+    print(
+        f"cassette of {os.path.getsize(cassette_path)} bytes replays "
+        f"{200 * (len(airport_questions) + 2) / elapsed:.0f} SDK calls/s"
+    )
+
+    # Most of that time goes to the SDK building requests and response models;
+    # the replay itself runs at memory speed
+    raw_client = httpx.Client(
+        transport=CassetteTransport(player, httpx.HTTPTransport())
+    )
+    start = time.perf_counter()
+    for i in range(2000):
+        raw_client.get(cassette_stub_url + "/airports", params={"apt": "JFK"})
+    elapsed = time.perf_counter() - start
+    print(f"raw transport replays {2000 / elapsed:.0f} calls/s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the benchmarks against local mock servers"
+    )
+    parser.add_argument("names", nargs="*", help="benchmarks to run (default: all)")
+    parser.add_argument("--list", action="store_true", help="list the benchmarks")
+    args = parser.parse_args(argv)
+    if args.list:
+        print("\n".join(benchmarks))
+        return
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmark: {', '.join(unknown)}")
+    for name in args.names or benchmarks:
+        print(f"== {name}")
+        benchmarks[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+# Command-line entry point for the course flows. Heavy libraries (openai,
+# tiktoken, tenacity, requests, dotenv) are imported inside the commands that
+# need them, so short-lived workers only pay for what they use.
+import argparse
+import csv
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+from common import (
+    DEFAULT_MODEL,
+    ENCODINGS,
+    TIKTOKEN_CACHE_DIR,
+    airport_tools,
+    build_review_messages,
+    compile_schema,
+    count_text_tokens,
+    loads_json,
+    review_tools,
+)
+
+# Reject fields the schema does not declare as well as mistyped ones
+review_validator = compile_schema(
+    {**review_tools[0]["function"]["parameters"], "additionalProperties": False}
+)
+
+
+def get_client():
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    load_dotenv()
+    return OpenAI()
+
+
+def create_with_retry(client, **params):
+    from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+    create = retry(
+        wait=wait_random_exponential(min=5, max=40), stop=stop_after_attempt(4)
+    )(client.chat.completions.create)
+    return create(**params)
+
+
+def prepare_review(review, model, max_tokens):
+    # Runs in a worker process during bulk extraction
+    if max_tokens and count_text_tokens(review, model) > max_tokens:
+        raise ValueError("Message exceeds token limit")
+    return build_review_messages(review)
+
+
+def validate_review_info(arguments):
+    # Runs in a worker process during bulk extraction
+    review_info = loads_json(arguments)
+    review_validator(review_info)
+    return review_info
+
+
+def json_mode(args):
+    response = create_with_retry(
+        get_client(),
+        model=args.model,
+        messages=[{"role": "user", "content": args.text}],
+        response_format={"type": "json_object"},
+    )
+    print(response.choices[0].message.content)
+
+
+def extract(args):
+    try:
+        messages = prepare_review(args.review, args.model, args.max_tokens)
+    except ValueError as error:
+        sys.exit(str(error))
+    response = create_with_retry(
+        get_client(),
+        model=args.model,
+        messages=messages,
+        tools=review_tools,
+        tool_choice={
+            "type": "function",
+            "function": {"name": "extract_sentiment_and_product_features"},
+        },
+    )
+    print(response.choices[0].message.tool_calls[0].function.arguments)
+
+
+def read_reviews(path, text_field="review"):
+    # Yield one record at a time so memory does not grow with the corpus
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for row, record in enumerate(records):
+            yield row, record.get("id", row), record[text_field]
+
+
+def is_retryable(error):
+    # Outages, overload and timeouts may succeed on a later run; bad requests,
+    # oversized reviews and invalid arguments will not
+    import openai
+    from tenacity import RetryError
+
+    if isinstance(error, RetryError):
+        error = error.last_attempt.exception()
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return isinstance(error, (openai.APIConnectionError, TimeoutError))
+
+
+def load_checkpoint(output_path):
+    # Every row below the watermark is in the output; rows at or above it
+    # may have been written since the last checkpoint and are collected here.
+    # Rows that failed with a retryable error are only in OUTPUT.retry, so they
+    # are not done.
+    watermark = 0
+    if os.path.exists(output_path + ".checkpoint"):
+        with open(output_path + ".checkpoint") as f:
+            watermark = json.load(f)["row"]
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path, "rb+") as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                result = json.loads(line)
+                if result["row"] >= watermark:
+                    done.add(result["row"])
+            # Drop a line cut short by a crash so appends start cleanly
+            f.truncate(offset)
+    return watermark, done
+
+
+def save_checkpoint(output_path, watermark):
+    with open(output_path + ".checkpoint.tmp", "w") as f:
+        json.dump({"row": watermark}, f)
+    os.replace(output_path + ".checkpoint.tmp", output_path + ".checkpoint")
+
+
+async def run_bulk_extract(args, pool):
+    import asyncio
+    from dotenv import load_dotenv
+    from openai import AsyncOpenAI
+    from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+    load_dotenv()
+    client = AsyncOpenAI()
+    loop = asyncio.get_running_loop()
+
+    @retry(wait=wait_random_exponential(min=5, max=40), stop=stop_after_attempt(4))
+    async def create(**params):
+        return await client.chat.completions.create(**params)
+
+    watermark, done = load_checkpoint(args.output)
+    # Bound the rows held in memory as well as the requests on the wire
+    window = asyncio.Semaphore(args.concurrency * 4)
+    api_slots = asyncio.Semaphore(args.concurrency)
+    in_flight = set()
+    retryable = set()
+    tasks = set()
+    counts = {"ok": 0, "error": 0}
+    next_row = watermark
+
+    async def process(output, retry_output, row, record_id, review):
+        try:
+            messages = await loop.run_in_executor(
+                pool, prepare_review, review, args.model, args.max_tokens
+            )
+            async with api_slots:
+                response = await create(
+                    model=args.model,
+                    messages=messages,
+                    tools=review_tools,
+                    tool_choice={
+                        "type": "function",
+                        "function": {"name": "extract_sentiment_and_product_features"},
+                    },
+                )
+            arguments = response.choices[0].message.tool_calls[0].function.arguments
+            review_info = await loop.run_in_executor(
+                pool, validate_review_info, arguments
+            )
+            result = {"row": row, "id": record_id, **review_info}
+            counts["ok"] += 1
+        except Exception as error:
+            result = {"row": row, "id": record_id, "error": repr(error)}
+            if is_retryable(error):
+                # Keep the watermark below this row so a resume retries it, and
+                # keep it out of OUTPUT so the retry leaves one line per row
+                retryable.add(row)
+            counts["error"] += 1
+        (retry_output if row in retryable else output).write(json.dumps(result) + "\n")
+        in_flight.discard(row)
+        window.release()
+        if (counts["ok"] + counts["error"]) % args.checkpoint_every == 0:
+            output.flush()
+            retry_output.flush()
+            save_checkpoint(args.output, min(in_flight | retryable, default=next_row))
+
+    start = time.perf_counter()
+    # OUTPUT.retry lists the rows left to retry after this run
+    with open(args.output, "a", encoding="utf-8") as output, open(
+        args.output + ".retry", "w", encoding="utf-8"
+    ) as retry_output:
+        for row, record_id, review in read_reviews(args.input, args.text_field):
+            next_row = row + 1
+            if row < watermark or row in done:
+                continue
+            await window.acquire()
+            in_flight.add(row)
+            task = asyncio.create_task(
+                process(output, retry_output, row, record_id, review)
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*list(tasks))
+    save_checkpoint(args.output, min(retryable, default=next_row))
+    return counts, time.perf_counter() - start
+
+
+def bulk_extract(args):
+    import asyncio
+    import resource
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Start the workers before the event loop so they fork from a quiet parent
+    with ProcessPoolExecutor(max_workers=args.processes) as pool:
+        counts, elapsed = asyncio.run(run_bulk_extract(args, pool))
+    processed = counts["ok"] + counts["error"]
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        f"{processed} reviews in {elapsed:.1f} s "
+        f"({processed / max(elapsed, 1e-9):.1f} reviews/sec), "
+        f"{counts['error']} errors, max RSS {max_rss:.0f} MB"
+    )
+
+
+def airport(args):
+    import requests
+
+    response = create_with_retry(
+        get_client(),
+        model=args.model,
+        messages=[
+            {
+                "role": "system",
+                "content": "You are an AI assistant, an aviation specialist. You should interpret the user prompt, and based on it extract an airport code corresponding to their message.",
+            },
+            {"role": "user", "content": args.question},
+        ],
+        tools=airport_tools,
+    )
+    if response.choices[0].finish_reason != "tool_calls":
+        sys.exit("I am sorry, but I could not understand your request.")
+    function_call = response.choices[0].message.tool_calls[0].function
+    code = json.loads(function_call.arguments)["airport_code"]
+    airport_info = requests.get(args.url, params={"apt": code}, timeout=10)
+    print(airport_info.text)
+
+
+def moderate(args):
+    moderation_response = get_client().moderations.create(input=args.text)
+    result = moderation_response.results[0]
+    print(json.dumps({"flagged": result.flagged, **result.categories.model_dump()}))
+
+
+def warm_cache(args):
+    # Download the BPE files once so later runs never touch the network
+    import tiktoken
+
+    for name in ENCODINGS:
+        tiktoken.get_encoding(name)
+    print(f"Cached {', '.join(ENCODINGS)} in {os.environ['TIKTOKEN_CACHE_DIR']}")
+
+
+def measure_startup(command, runs):
+    wall_times = []
+    import_times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", *command],
+            capture_output=True,
+            text=True,
+        )
+        wall_times.append(time.perf_counter() - start)
+        # Sum the cumulative time of top-level imports only
+        import_times.append(
+            sum(
+                int(match.group(1))
+                for match in re.finditer(
+                    r"import time:\s+\d+ \|\s+(\d+) \| [^ ]", result.stderr
+                )
+            )
+        )
+    return min(wall_times), min(import_times) / 1e6
+
+
+def benchmark_startup(args):
+    eager = "import openai, tiktoken, tenacity, requests, dotenv"
+    for name, command in [
+        ("cli --help", [os.path.abspath(__file__), "--help"]),
+        ("eager imports", ["-c", eager]),
+    ]:
+        wall_time, import_time = measure_startup(command, args.runs)
+        print(
+            f"{name:<14} wall={wall_time * 1000:7.1f} ms  imports={import_time * 1000:7.1f} ms"
+        )
+
+
+def main(argv=None):
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+    parser = argparse.ArgumentParser(description="Run the course flows")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    subparsers = parser.add_subparsers(required=True)
+
+    command = subparsers.add_parser("json-mode", help="Organize text as JSON")
+    command.add_argument("text")
+    command.set_defaults(handler=json_mode)
+
+    command = subparsers.add_parser("extract", help="Extract review information")
+    command.add_argument("review")
+    command.add_argument("--max-tokens", type=int, default=100)
+    command.set_defaults(handler=extract)
+
+    command = subparsers.add_parser(
+        "bulk-extract", help="Extract review information from a JSONL/CSV file"
+    )
+    command.add_argument("input")
+    command.add_argument("output")
+    command.add_argument("--text-field", default="review")
+    command.add_argument("--max-tokens", type=int, default=100)
+    command.add_argument("--concurrency", type=int, default=32)
+    command.add_argument("--processes", type=int, default=os.cpu_count())
+    command.add_argument("--checkpoint-every", type=int, default=100)
+    command.set_defaults(handler=bulk_extract)
+
+    command = subparsers.add_parser("airport", help="Look up an airport")
+    command.add_argument("question")
+    command.add_argument("--url", default="https://api.aviationapi.com/v1/airports")
+    command.set_defaults(handler=airport)
+
+    command = subparsers.add_parser("moderate", help="Run the moderation check")
+    command.add_argument("text")
+    command.set_defaults(handler=moderate)
+
+    command = subparsers.add_parser("warm-cache", help="Pre-download BPE files")
+    command.set_defaults(handler=warm_cache)
+
+    command = subparsers.add_parser("benchmark-startup", help="Time CLI startup")
+    command.add_argument("--runs", type=int, default=5)
+    command.set_defaults(handler=benchmark_startup)
+
+    args = parser.parse_args(argv)
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# Tool schemas and lightweight helpers shared by cli.py and toolkit.py. Only
+# the standard library is imported up front so the CLI stays quick to start;
+# tiktoken is loaded on first use.
+import functools
+import json
+import os
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+TIKTOKEN_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), ".tiktoken_cache"
+)
+ENCODINGS = ["cl100k_base", "o200k_base"]
+
+review_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "extract_sentiment_and_product_features",
+            "description": "Extract sentiment and product features from reviews",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "product": {"type": "string", "description": "The product name"},
+                    "sentiment": {
+                        "type": "string",
+                        "description": "The overall sentiment of the review",
+                    },
+                    "features": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "List of features mentioned in the review",
+                    },
+                    "suggestions": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "Suggestions for improvement",
+                    },
+                },
+            },
+        },
+    }
+]
+airport_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_airport_info",
+            "description": "This function calls the Aviation API to return the airport code corresponding to the airport in the request",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "airport_code": {
+                        "type": "string",
+                        "description": "The code to be passed to the get_airport_info function.",
+                    }
+                },
+                "required": ["airport_code"],
+            },
+        },
+    }
+]
+
+
+def build_review_messages(review):
+    return [
+        {
+            "role": "system",
+            "content": "Don't make assumptions about what values to plug into functions. Ask for clarification if a user request is ambiguous.",
+        },
+        {"role": "user", "content": review},
+    ]
+
+
+# Build each encoding once per process instead of on every check
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_text_tokens(text, model=DEFAULT_MODEL):
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+try:
+    import orjson
+
+    loads_json = orjson.loads
+except ImportError:
+    loads_json = json.loads
+
+
+class ValidationError(ValueError):
+    pass
+
+
+def compile_schema(schema, path="arguments"):
+    # Turn a JSON schema into a tree of checks once, instead of walking it per call
+    types = {"string": str, "integer": int, "number": (int, float), "boolean": bool}
+    kind = schema.get("type")
+    enum = schema.get("enum")
+    if kind == "object":
+        properties = {
+            name: compile_schema(subschema, f"{path}[{name!r}]")
+            for name, subschema in schema.get("properties", {}).items()
+        }
+        required = schema.get("required", [])
+        closed = schema.get("additionalProperties") is False
+
+        def check(value):
+            if not isinstance(value, dict):
+                raise ValidationError(f"{path} should be an object")
+            for name in required:
+                if name not in value:
+                    raise ValidationError(f"{path} is missing {name!r}")
+            if closed:
+                for name in value:
+                    if name not in properties:
+                        raise ValidationError(f"{path} has unexpected field {name!r}")
+            for name, check_property in properties.items():
+                if name in value:
+                    check_property(value[name])
+
+    elif kind == "array":
+        check_item = compile_schema(schema.get("items", {}), f"{path}[]")
+
+        def check(value):
+            if not isinstance(value, list):
+                raise ValidationError(f"{path} should be an array")
+            for item in value:
+                check_item(item)
+
+    elif kind in types:
+        expected = types[kind]
+
+        def check(value):
+            # bool is a subclass of int, so reject it for numeric fields
+            if not isinstance(value, expected) or (
+                isinstance(value, bool) and kind != "boolean"
+            ):
+                raise ValidationError(f"{path} should be of type {kind}")
+            if enum is not None and value not in enum:
+                raise ValidationError(f"{path} should be one of {enum}")
+
+    else:
+
+        def check(value):
+            pass
+
+    return check
+
+
+@functools.lru_cache(maxsize=None)
+def get_validator(schema_json):
+    return compile_schema(json.loads(schema_json))
@@ -0,0 +1,428 @@
+# Local stand-in for the OpenAI API and the aviation API, so the benchmarks
+# run without an API key or network access
+import array
+import base64
+import email.policy
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def mock_value(schema, name, indexes=()):
+    kind = schema.get("type")
+    if kind == "object":
+        return {
+            key: mock_value(subschema, key, indexes)
+            for key, subschema in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        items = schema.get("items", {"type": "string"})
+        # Answer packed requests with one result per numbered input item
+        if indexes and "index" in items.get("properties", {}):
+            return [{**mock_value(items, name), "index": i} for i in indexes]
+        return [mock_value(items, name)]
+    if kind == "string":
+        return f"mock {name}"
+    return {"integer": 0, "number": 0.0, "boolean": False}.get(kind)
+
+
+def mock_arguments(parameters, indexes=()):
+    return mock_value({"type": "object", **parameters}, "arguments", indexes)
+
+
+def mock_chat_completion(body):
+    message = {"role": "assistant", "content": None}
+    finish_reason = "tool_calls"
+    if body.get("tools") and body["messages"][-1]["role"] != "tool":
+        # Call the forced tool, otherwise every tool offered
+        names = [tool["function"]["name"] for tool in body["tools"]]
+        if isinstance(body.get("tool_choice"), dict):
+            names = [body["tool_choice"]["function"]["name"]]
+        message["tool_calls"] = []
+        indexes = [
+            int(i)
+            for i in re.findall(r'"index": (\d+)', body["messages"][-1]["content"])
+        ]
+        for index, name in enumerate(names):
+            tool = next(t for t in body["tools"] if t["function"]["name"] == name)
+            arguments = mock_arguments(tool["function"].get("parameters", {}), indexes)
+            message["tool_calls"].append(
+                {
+                    "id": f"call_mock{index}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": json.dumps(arguments)},
+                }
+            )
+    elif body.get("response_format", {}).get("type") == "json_object":
+        # Answer with a JSON object matching any schema quoted in the prompt
+        schema = {}
+        for prompt in body["messages"]:
+            if "JSON schema: " in prompt["content"]:
+                schema = json.loads(prompt["content"].split("JSON schema: ", 1)[1])
+        message["content"] = json.dumps(mock_value(schema, "result"), indent=1)
+        finish_reason = "stop"
+    elif body["messages"][0]["content"].startswith("Summarize"):
+        # Keep conversation summaries short, as a real model would
+        lines = body["messages"][-1]["content"].count("\n") + 1
+        message["content"] = f"Mock summary of {lines} lines."
+        finish_reason = "stop"
+    else:
+        message["content"] = "Mock reply to: " + body["messages"][-1]["content"]
+        finish_reason = "stop"
+    return {
+        "id": "chatcmpl-mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    }
+
+
+def mock_stream_chunks(completion, fragment_size=8):
+    # Split a completion into chat.completion.chunk deltas
+    choice = completion["choices"][0]
+    deltas = [{"role": "assistant", "content": ""}]
+    content = choice["message"]["content"] or ""
+    deltas += [{"content": word} for word in re.findall(r"\S+\s*", content)]
+    for index, tool_call in enumerate(choice["message"].get("tool_calls") or []):
+        function = tool_call["function"]
+        deltas.append(
+            {
+                "tool_calls": [
+                    {
+                        "index": index,
+                        "id": tool_call["id"],
+                        "type": "function",
+                        "function": {"name": function["name"], "arguments": ""},
+                    }
+                ]
+            }
+        )
+        arguments = function["arguments"]
+        for start in range(0, len(arguments), fragment_size):
+            fragment = arguments[start : start + fragment_size]
+            deltas.append(
+                {"tool_calls": [{"index": index, "function": {"arguments": fragment}}]}
+            )
+    chunks = [
+        {"index": 0, "delta": delta, "finish_reason": None} for delta in deltas
+    ] + [{"index": 0, "delta": {}, "finish_reason": choice["finish_reason"]}]
+    for choice_chunk in chunks:
+        yield {
+            "id": completion["id"],
+            "object": "chat.completion.chunk",
+            "created": completion["created"],
+            "model": completion["model"],
+            "choices": [choice_chunk],
+        }
+
+
+def mock_moderation(body):
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    categories = [
+        "harassment",
+        "harassment/threatening",
+        "hate",
+        "hate/threatening",
+        "self-harm",
+        "self-harm/instructions",
+        "self-harm/intent",
+        "sexual",
+        "sexual/minors",
+        "violence",
+        "violence/graphic",
+    ]
+    results = []
+    for text in inputs:
+        # Flag anything that talks about killing as violence
+        violent = "kill" in text.lower()
+        results.append(
+            {
+                "flagged": violent,
+                "categories": {
+                    category: violent and category == "violence"
+                    for category in categories
+                },
+                "category_scores": {
+                    category: 0.9 if violent and category == "violence" else 0.0
+                    for category in categories
+                },
+            }
+        )
+    return {"id": "modr-mock", "model": "text-moderation-007", "results": results}
+
+
+def mock_embeddings(body):
+    # Hashed bag of words, so texts sharing most words get similar vectors
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    dimensions = body.get("dimensions", 256)
+    data = []
+    for index, text in enumerate(inputs):
+        vector = [0.0] * dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode()) % dimensions] += 1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        vector = [value / norm for value in vector]
+        if body.get("encoding_format") == "base64":
+            vector = base64.b64encode(array.array("f", vector).tobytes()).decode()
+        data.append({"object": "embedding", "index": index, "embedding": vector})
+    return {
+        "object": "list",
+        "model": body["model"],
+        "data": data,
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    }
+
+
+def mock_batch_output(input_jsonl, failed_custom_ids=()):
+    # Split results into the output file and the error file, as the Batch API does
+    lines = {"output": [], "errors": []}
+    for line in input_jsonl.splitlines():
+        request = json.loads(line)
+        if request["custom_id"] in failed_custom_ids:
+            kind = "errors"
+            response = {
+                "status_code": 500,
+                "request_id": "req-mock",
+                "body": {
+                    "error": {"message": "Mock server_error", "type": "server_error"}
+                },
+            }
+        else:
+            kind = "output"
+            response = {
+                "status_code": 200,
+                "request_id": "req-mock",
+                "body": mock_chat_completion(request["body"]),
+            }
+        lines[kind].append(
+            json.dumps(
+                {
+                    "id": "batch_req_mock",
+                    "custom_id": request["custom_id"],
+                    "response": response,
+                    "error": None,
+                }
+            )
+        )
+    return {
+        kind: ("\n".join(kind_lines) + "\n").encode() if kind_lines else None
+        for kind, kind_lines in lines.items()
+    }
+
+
+def start_mock_server(
+    latency=0.1,
+    chunk_delay=0.01,
+    jitter=0.0,
+    tail_rate=0.0,
+    tail_latency=1.0,
+    error_rate=0.0,
+    rate_limit_rate=0.0,
+    seed=0,
+):
+    # Uploaded files and batches of the fake Batch API
+    files = {}
+    batches = {}
+    # Seeded so the same settings inject the same sequence of delays and errors
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    prompt_prefixes = set()
+
+    class MockHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def send_body(self, data, content_type="application/json", status=200):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            if status == 429:
+                self.send_header("retry-after", "0.05")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def inject_failure(self):
+            with rng_lock:
+                delay = latency + rng.uniform(0, jitter)
+                # A small share of requests hit a slow tail
+                if rng.random() < tail_rate:
+                    delay += tail_latency
+                roll = rng.random()
+            time.sleep(delay)
+            if roll < rate_limit_rate:
+                status, kind = 429, "rate_limit_exceeded"
+            elif self.server.outage or roll < rate_limit_rate + error_rate:
+                status, kind = 500, "server_error"
+            else:
+                return False
+            error = {"error": {"message": f"Mock {kind}", "type": kind, "code": kind}}
+            self.send_body(json.dumps(error).encode(), status=status)
+            return True
+
+        def do_POST(self):
+            self.server.request_count += 1
+            length = int(self.headers["Content-Length"])
+            raw_body = self.rfile.read(length)
+            if len(raw_body) < length:
+                # The client hung up before sending the whole body
+                self.close_connection = True
+                return
+            if self.inject_failure():
+                return
+            path = urlparse(self.path).path
+            if path.endswith("/files"):
+                payload = self.create_file(raw_body)
+            elif path.endswith("/batches"):
+                payload = self.create_batch(json.loads(raw_body))
+            elif path.endswith("/moderations"):
+                payload = mock_moderation(json.loads(raw_body))
+            elif path.endswith("/embeddings"):
+                payload = mock_embeddings(json.loads(raw_body))
+            else:
+                body = json.loads(raw_body)
+                payload = mock_chat_completion(body)
+                # Simulate the provider prompt cache on everything but the last message
+                prefix = json.dumps([body.get("tools"), body["messages"][:-1]])
+                with rng_lock:
+                    cached = prefix in prompt_prefixes
+                    prompt_prefixes.add(prefix)
+                usage = payload["usage"]
+                usage["prompt_tokens"] = len(raw_body) // 4
+                usage["total_tokens"] = (
+                    usage["prompt_tokens"] + usage["completion_tokens"]
+                )
+                usage["prompt_tokens_details"] = {
+                    "cached_tokens": len(prefix) // 4 if cached else 0
+                }
+                if body.get("stream"):
+                    return self.send_stream(payload)
+            self.send_body(json.dumps(payload).encode())
+
+        def send_stream(self, completion):
+            # Server-sent events, closing the connection to end the stream
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for chunk in mock_stream_chunks(completion):
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(chunk_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+        def do_GET(self):
+            self.server.request_count += 1
+            url = urlparse(self.path)
+            if self.inject_failure():
+                return
+            parts = url.path.strip("/").split("/")
+            if parts[-1] == "batches":
+                # Newest first, paged with the after cursor
+                query = parse_qs(url.query)
+                data = list(reversed(batches.values()))
+                if "after" in query:
+                    ids = [batch["id"] for batch in data]
+                    data = data[ids.index(query["after"][0]) + 1 :]
+                limit = int(query.get("limit", ["20"])[0])
+                payload = {
+                    "object": "list",
+                    "data": data[:limit],
+                    "has_more": len(data) > limit,
+                }
+                self.send_body(json.dumps(payload).encode())
+            elif parts[-2:-1] == ["batches"]:
+                self.send_body(json.dumps(batches[parts[-1]]).encode())
+            elif parts[-1] == "content":
+                self.send_body(files[parts[-2]], "application/octet-stream")
+            else:
+                # Stub of the aviation API: /v1/airports?apt=JFK,LAX
+                codes = parse_qs(url.query).get("apt", [""])[0].split(",")
+                payload = {
+                    code: [{"facility_name": f"{code} MOCK AIRPORT", "faa_ident": code}]
+                    for code in codes
+                }
+                self.send_body(json.dumps(payload).encode())
+
+        def create_file(self, raw_body):
+            headers = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n"
+            message = BytesParser(policy=email.policy.default).parsebytes(
+                headers.encode() + raw_body
+            )
+            for part in message.iter_parts():
+                if part.get_param("name", header="content-disposition") == "file":
+                    data = part.get_payload(decode=True)
+            file_id = f"file-mock{len(files)}"
+            files[file_id] = data
+            return {
+                "id": file_id,
+                "object": "file",
+                "bytes": len(data),
+                "created_at": int(time.time()),
+                "filename": "batch.jsonl",
+                "purpose": "batch",
+                "status": "processed",
+            }
+
+        def create_batch(self, body):
+            # Process the whole batch immediately
+            batch_id = f"batch_mock{len(batches)}"
+            batch = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "created_at": int(time.time()),
+                "status": self.server.batch_status,
+                "metadata": body.get("metadata"),
+            }
+            if batch["status"] == "failed":
+                batch["errors"] = {
+                    "object": "list",
+                    "data": [{"code": "invalid_request", "message": "Mock failure"}],
+                }
+            else:
+                output = mock_batch_output(
+                    files[body["input_file_id"]].decode(),
+                    self.server.failed_custom_ids,
+                )
+                for kind, data in output.items():
+                    if data is not None:
+                        file_id = f"file-mock{len(files)}"
+                        files[file_id] = data
+                        key = "output_file_id" if kind == "output" else "error_file_id"
+                        batch[key] = file_id
+            batches[batch_id] = batch
+            return batch
+
+        def log_message(self, format, *args):
+            pass
+
+    class MockServer(ThreadingHTTPServer):
+        request_queue_size = 128
+        request_count = 0
+        # Set to True to fail every request, as in an upstream outage
+        outage = False
+        # Final status of new batches, and requests the Batch API reports as failed
+        batch_status = "completed"
+        failed_custom_ids = ()
+
+        def handle_error(self, request, client_address):
+            # Clients hanging up mid-response (e.g. cancelled hedges) are expected
+            if not isinstance(sys.exc_info()[1], ConnectionError):
+                super().handle_error(request, client_address)
+
+    server = MockServer(("127.0.0.1", 0), MockHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1"
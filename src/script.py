@@ -1,14 +1,14 @@
 # added/edited
 from dotenv import load_dotenv
-from openai import OpenAI
 import os
 import openai
+from toolkit import count_chat_tokens, get_http_session, get_openai_client
 
 load_dotenv()
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Create the request
 response = client.chat.completions.create(
@@ -34,7 +34,7 @@ message = {
 }
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Use the try statement
 try:
@@ -52,7 +52,7 @@ except openai.AuthenticationError as e:
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 
 # Add the appropriate parameters to the decorator
@@ -79,7 +79,7 @@ def get_response(messages):
 
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 messages = []
 # Provide a system message and user messages to send the batch
@@ -97,19 +97,15 @@ print(response)
 
 
 # added/edited
-import tiktoken
-
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 input_message = {
     "role": "user",
     "content": "I'd like to buy a shirt and a jacket. Can you suggest two color pairings for these items?",
 }
 
-# Use tiktoken to create the encoding for your model
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-# Check for the number of tokens
-num_tokens = len(encoding.encode(input_message["content"]))
+# Check for the number of tokens, including per-message overhead
+num_tokens = count_chat_tokens([input_message])
 
 # Run the chat completions function and print the response
 if num_tokens <= 100:
@@ -155,7 +151,7 @@ function_definition = [
 ]
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 response = client.chat.completions.create(
     model="gpt-3.5-turbo",
@@ -200,7 +196,7 @@ def get_response(messages, function_definition):
 
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Define the function parameter type
 function_definition[0]["function"]["parameters"]["type"] = "object"
@@ -268,7 +264,7 @@ def get_response(messages, function_definition):
 
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 response = get_response(messages, function_definition)
 
@@ -320,7 +316,7 @@ function_definition = [
 ]
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Append the second function
 function_definition.append(
@@ -379,7 +375,7 @@ function_definition = [
 ]
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 response = client.chat.completions.create(
     model=model,
@@ -448,7 +444,7 @@ function_definition = [
 ]
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Modify the messages
 messages.append(
@@ -465,7 +461,6 @@ print(response)
 
 # added/edited
 import json
-import requests
 
 
 def get_response(function_definition):
@@ -507,12 +502,12 @@ def postprocess_response(response):
 def get_airport_info(airport_code):
     url = "https://api.aviationapi.com/v1/airports"
     querystring = {"apt": airport_code}
-    response = requests.request("GET", url, params=querystring)
+    response = get_http_session().get(url, params=querystring)
     return response.text
 
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Define the function to pass to tools
 function_definition = [
@@ -583,7 +578,7 @@ function_definition = [
 ]
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Call the Chat Completions endpoint
 response = client.chat.completions.create(
@@ -627,7 +622,7 @@ else:
 
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 message = "Can you show some example sentences in the past tense in French?"
 
@@ -639,7 +634,7 @@ print(moderation_response.results[0].categories)
 
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 user_request = "Can you recommend a good restaurant in Berlin?"
 
@@ -659,7 +654,7 @@ print(response.choices[0].message.content)
 
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 messages = [
     {"role": "system", "content": "You are a personal finance assistant."},
@@ -680,7 +675,7 @@ print(response.choices[0].message.content)
 import uuid
 
 # Set up your OpenAI API key
-client = OpenAI()
+client = get_openai_client()
 
 # Generate a unique ID
 unique_id = str(uuid.uuid4())
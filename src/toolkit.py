@@ -0,0 +1,2437 @@
+# Production helpers for the course flows: pooled clients, telemetry,
+# deadlines, caching, rate limiting, resilience and structured output
+import asyncio
+import atexit
+import base64
+import contextlib
+import contextvars
+import dataclasses
+import email.utils
+import functools
+import gzip
+import hashlib
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import urllib.request
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import httpx
+import numpy as np
+import openai
+import requests
+from dotenv import load_dotenv
+from openai import AsyncOpenAI, OpenAI
+from openai.types import ModerationCreateResponse
+from openai.types.chat import ChatCompletion
+from tenacity import (
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+from common import (
+    TIKTOKEN_CACHE_DIR,
+    ValidationError,
+    compile_schema,
+    count_text_tokens,
+    get_encoding,
+    get_validator,
+    loads_json,
+)
+
+try:
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer("developing-ai-systems")
+except ImportError:
+    tracer = None
+
+load_dotenv()
+# Share the BPE files pre-warmed by `python cli.py warm-cache`
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+
+# Dollars per million prompt and completion tokens
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (5.00, 15.00),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def model_price(model):
+    # Dated snapshots such as gpt-3.5-turbo-0125 match their base model
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_PRICES[name]
+    return (0.0, 0.0)
+
+
+class LatencyHistogram:
+    # HDR-style log-linear buckets: 16 per power of two, within about 6%
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, seconds):
+        micros = max(int(seconds * 1e6), 1)
+        shift = max(micros.bit_length() - 5, 0)
+        self.counts[((micros >> shift) + 1) << shift] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, quantile):
+        target = quantile * self.count
+        seen = 0
+        for upper_bound in sorted(self.counts):
+            seen += self.counts[upper_bound]
+            if seen >= target:
+                return upper_bound / 1e6
+        return 0.0
+
+
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(LatencyHistogram)
+        self.time_to_first_byte = defaultdict(LatencyHistogram)
+        self.counters = defaultdict(Counter)
+        self.current = contextvars.ContextVar("telemetry_call", default=None)
+
+    def new_call(self, call_site, start=None):
+        return {
+            "call_site": call_site,
+            "start": start or time.perf_counter(),
+            "attempts": 0,
+            "time_to_first_byte": None,
+            "model": None,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "completion_tokens": 0,
+            "error": False,
+        }
+
+    @contextlib.contextmanager
+    def track(self, call_site):
+        # Label every API request made inside the block with this call site
+        call = self.new_call(call_site)
+        token = self.current.set(call)
+        try:
+            yield call
+        except Exception:
+            call["error"] = True
+            raise
+        finally:
+            self.current.reset(token)
+            self.record(call)
+
+    def begin_attempt(self, path, start=None):
+        # Requests made outside track() are recorded on their own by endpoint,
+        # with ids such as file-abc123 collapsed to keep label cardinality low
+        call = self.current.get()
+        implicit = call is None
+        if implicit:
+            endpoint = "/".join(
+                "{id}" if len(part) > 4 and any(c.isdigit() for c in part) else part
+                for part in path.split("/")
+            )
+            call = self.new_call(endpoint, start)
+        call["attempts"] += 1
+        return call, implicit
+
+    def observe_body(self, call, body):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return
+        if isinstance(payload, dict):
+            usage = payload.get("usage") or {}
+            call["model"] = payload.get("model") or call["model"]
+            call["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            call["completion_tokens"] += usage.get("completion_tokens", 0)
+            details = usage.get("prompt_tokens_details") or {}
+            call["cached_tokens"] += details.get("cached_tokens", 0)
+
+    def record(self, call):
+        wall_time = time.perf_counter() - call["start"]
+        site = call["call_site"]
+        model = call["model"] or "unknown"
+        prompt_price, completion_price = model_price(model)
+        # Prompt tokens served from the provider cache are billed at half price
+        cost = (
+            (call["prompt_tokens"] - call["cached_tokens"] / 2) * prompt_price
+            + call["completion_tokens"] * completion_price
+        ) / 1e6
+        labels = (("call_site", site), ("model", model))
+        with self.lock:
+            self.latency[site].record(wall_time)
+            if call["time_to_first_byte"] is not None:
+                self.time_to_first_byte[site].record(call["time_to_first_byte"])
+            self.counters["openai_calls_total"][labels] += 1
+            self.counters["openai_retries_total"][labels] += max(
+                call["attempts"] - 1, 0
+            )
+            self.counters["openai_errors_total"][labels] += call["error"]
+            for kind in ["prompt", "cached", "completion"]:
+                self.counters["openai_tokens_total"][
+                    labels + (("kind", kind),)
+                ] += call[f"{kind}_tokens"]
+            self.counters["openai_cost_dollars_total"][labels] += cost
+        if tracer is not None:
+            # Emit an OpenTelemetry span when the SDK is installed
+            start_ns = time.time_ns() - int(wall_time * 1e9)
+            span = tracer.start_span(site, start_time=start_ns)
+            span.set_attributes(
+                {
+                    key: value
+                    for key, value in call.items()
+                    if isinstance(value, (str, int, float)) and key != "start"
+                }
+            )
+            span.end()
+
+    def requests_hook(self, response, *args, **kwargs):
+        elapsed = response.elapsed.total_seconds()
+        call, implicit = self.begin_attempt(
+            response.request.path_url.split("?")[0],
+            start=time.perf_counter() - elapsed,
+        )
+        call["time_to_first_byte"] = call["time_to_first_byte"] or elapsed
+        call["error"] = call["error"] or response.status_code >= 400
+        if implicit:
+            self.record(call)
+
+    def export_prometheus(self):
+        lines = []
+        with self.lock:
+            for metric, histograms in [
+                ("openai_request_duration_seconds", self.latency),
+                ("openai_time_to_first_byte_seconds", self.time_to_first_byte),
+            ]:
+                lines.append(f"# TYPE {metric} summary")
+                for site, histogram in sorted(histograms.items()):
+                    for quantile in [0.5, 0.9, 0.99]:
+                        lines.append(
+                            f'{metric}{{call_site="{site}",quantile="{quantile}"}} '
+                            f"{histogram.percentile(quantile):.6f}"
+                        )
+                    lines.append(
+                        f'{metric}_sum{{call_site="{site}"}} {histogram.sum:.6f}'
+                    )
+                    lines.append(
+                        f'{metric}_count{{call_site="{site}"}} {histogram.count}'
+                    )
+            for metric, counter in sorted(self.counters.items()):
+                lines.append(f"# TYPE {metric} counter")
+                for labels, value in sorted(counter.items()):
+                    label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                    lines.append(f"{metric}{{{label_text}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+telemetry = Telemetry()
+
+
+class InstrumentedStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    # Watch the response body go by to pick up usage, then close the record
+    def __init__(self, stream, call, implicit, is_json):
+        self.stream = stream
+        self.call = call
+        self.implicit = implicit
+        self.chunks = [] if is_json else None
+
+    def __iter__(self):
+        for chunk in self.stream:
+            if self.chunks is not None:
+                self.chunks.append(chunk)
+            yield chunk
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            if self.chunks is not None:
+                self.chunks.append(chunk)
+            yield chunk
+
+    def finish(self):
+        if self.chunks:
+            telemetry.observe_body(self.call, b"".join(self.chunks))
+            self.chunks = None
+        if self.implicit:
+            self.implicit = False
+            telemetry.record(self.call)
+
+    def close(self):
+        self.stream.close()
+        self.finish()
+
+    async def aclose(self):
+        await self.stream.aclose()
+        self.finish()
+
+
+def instrument_response(response, call, implicit, start):
+    call["time_to_first_byte"] = call["time_to_first_byte"] or (
+        time.perf_counter() - start
+    )
+    call["error"] = call["error"] or response.status_code >= 400
+    is_json = response.headers.get("content-type", "").startswith("application/json")
+    return httpx.Response(
+        status_code=response.status_code,
+        headers=response.headers,
+        stream=InstrumentedStream(response.stream, call, implicit, is_json),
+        extensions=response.extensions,
+    )
+
+
+class InstrumentedTransport(httpx.HTTPTransport):
+    def handle_request(self, request):
+        start = time.perf_counter()
+        call, implicit = telemetry.begin_attempt(request.url.path, start)
+        try:
+            response = super().handle_request(request)
+        except Exception:
+            call["error"] = True
+            if implicit:
+                telemetry.record(call)
+            raise
+        return instrument_response(response, call, implicit, start)
+
+
+class InstrumentedAsyncTransport(httpx.AsyncHTTPTransport):
+    async def handle_async_request(self, request):
+        start = time.perf_counter()
+        call, implicit = telemetry.begin_attempt(request.url.path, start)
+        try:
+            response = await super().handle_async_request(request)
+        except Exception:
+            call["error"] = True
+            if implicit:
+                telemetry.record(call)
+            raise
+        return instrument_response(response, call, implicit, start)
+
+
+class CassetteMiss(LookupError):
+    pass
+
+
+class Cassette:
+    # Recorded HTTP exchanges, saved as gzipped JSON. Modes are "record"
+    # (always call through), "replay" (never touch the network) and "auto"
+    # (replay what was recorded, record the rest).
+    def __init__(self, path, mode="replay"):
+        self.path = path
+        self.mode = mode
+        self.entries = {}
+        self.positions = Counter()
+        self.lock = threading.Lock()
+        self.dirty = False
+        if mode != "record" and os.path.exists(path):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def make_key(method, url, body, content_type=""):
+        # Host and port are left out so fixtures replay against any base URL
+        url = httpx.URL(url)
+        query = httpx.QueryParams(sorted(url.params.multi_items()))
+        boundary = re.search(r"boundary=([^;]+)", content_type or "")
+        if boundary:
+            # Multipart boundaries are random on every request
+            body = body.replace(boundary.group(1).encode(), b"boundary")
+        elif body:
+            try:
+                body = json.dumps(json.loads(body), sort_keys=True).encode()
+            except ValueError:
+                pass
+        digest = hashlib.sha256(body or b"").hexdigest()
+        return f"{method} {url.path}?{query} {digest}"
+
+    def play(self, key):
+        # Identical requests replay in recorded order, then repeat the last one
+        with self.lock:
+            responses = self.entries.get(key)
+            if not responses:
+                if self.mode == "replay":
+                    raise CassetteMiss(f"No recorded response for {key}")
+                return None
+            position = min(self.positions[key], len(responses) - 1)
+            self.positions[key] += 1
+        response = responses[position]
+        if "text" in response:
+            return response["status"], response["headers"], response["text"].encode()
+        return (
+            response["status"],
+            response["headers"],
+            base64.b64decode(response["base64"]),
+        )
+
+    def record(self, key, status, headers, body):
+        # Bodies are stored decoded, so drop headers that describe the wire format
+        headers = {
+            name: value
+            for name, value in headers.items()
+            if name.lower()
+            not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        response = {"status": status, "headers": headers}
+        try:
+            response["text"] = body.decode()
+        except UnicodeDecodeError:
+            response["base64"] = base64.b64encode(body).decode()
+        with self.lock:
+            self.entries.setdefault(key, []).append(response)
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            with gzip.open(self.path + ".tmp", "wt", encoding="utf-8") as f:
+                json.dump(self.entries, f, separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+            self.dirty = False
+
+
+class CassetteTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    def __init__(self, cassette, transport):
+        self.cassette = cassette
+        self.transport = transport
+
+    def make_key(self, request):
+        return self.cassette.make_key(
+            request.method,
+            str(request.url),
+            request.content,
+            request.headers.get("content-type"),
+        )
+
+    def replay(self, key):
+        if self.cassette.mode == "record":
+            return None
+        recorded = self.cassette.play(key)
+        if recorded is not None:
+            status, headers, body = recorded
+            return httpx.Response(status, headers=headers, content=body)
+
+    def record(self, key, response, body):
+        self.cassette.record(key, response.status_code, response.headers, body)
+        # Streamed chunks are buffered here and replayed as one body
+        headers = [
+            (name, value)
+            for name, value in response.headers.multi_items()
+            if name.lower() not in ("content-encoding", "content-length")
+        ]
+        return httpx.Response(response.status_code, headers=headers, content=body)
+
+    def handle_request(self, request):
+        request.read()
+        key = self.make_key(request)
+        response = self.replay(key)
+        if response is not None:
+            return response
+        response = self.transport.handle_request(request)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        return self.record(key, response, body)
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        key = self.make_key(request)
+        response = self.replay(key)
+        if response is not None:
+            return response
+        response = await self.transport.handle_async_request(request)
+        try:
+            body = await response.aread()
+        finally:
+            await response.aclose()
+        return self.record(key, response, body)
+
+    def close(self):
+        self.transport.close()
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class CassetteAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, cassette, **kwargs):
+        self.cassette = cassette
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        body = request.body or b""
+        key = self.cassette.make_key(
+            request.method,
+            request.url,
+            body.encode() if isinstance(body, str) else body,
+            request.headers.get("Content-Type"),
+        )
+        recorded = None if self.cassette.mode == "record" else self.cassette.play(key)
+        if recorded is None:
+            response = super().send(request, **kwargs)
+            self.cassette.record(
+                key, response.status_code, response.headers, response.content
+            )
+            return response
+        response = requests.Response()
+        response.status_code, headers, response._content = recorded
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        return response
+
+
+# CASSETTE_PATH=fixtures.json.gz CASSETTE_MODE=record|replay|auto runs every
+# call made through the shared clients below against recorded fixtures
+default_cassette = None
+if os.environ.get("CASSETTE_PATH"):
+    default_cassette = Cassette(
+        os.environ["CASSETTE_PATH"], os.environ.get("CASSETTE_MODE", "replay")
+    )
+    atexit.register(default_cassette.save)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    # Nested deadlines can only shorten the time left, never extend it
+    current = request_deadline.get()
+    new = time.monotonic() + seconds
+    token = request_deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+def remaining_time(default=None):
+    current = request_deadline.get()
+    if current is None:
+        return default
+    remaining = current - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("The request deadline has passed")
+    if isinstance(default, (int, float)):
+        return min(remaining, default)
+    return remaining
+
+
+# Share one pooled client per configuration across the whole process
+@functools.lru_cache(maxsize=None)
+def environment_proxies():
+    # httpx skips HTTP(S)_PROXY, ALL_PROXY and NO_PROXY once a client is given
+    # its own transport, so the clients below mount the same routes themselves.
+    # Hosts that bypass the proxy map to None, the client's default transport.
+    proxies = urllib.request.getproxies()
+    routes = {}
+    for scheme in ("http", "https", "all"):
+        if proxies.get(scheme):
+            url = proxies[scheme]
+            routes[f"{scheme}://"] = url if "://" in url else f"http://{url}"
+    for host in proxies.get("no", "").split(","):
+        host = host.strip()
+        if host == "*":
+            return {}
+        if not host:
+            continue
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            address = None
+        if "://" in host:
+            routes[host] = None
+        elif address is not None and address.version == 6:
+            routes[f"all://[{host}]"] = None
+        elif address is not None or host.lower() == "localhost":
+            routes[f"all://{host}"] = None
+        else:
+            routes[f"all://*{host}"] = None
+    return routes
+
+
+def get_openai_client(
+    base_url=None,
+    api_key=None,
+    max_connections=100,
+    max_keepalive_connections=20,
+    keepalive_expiry=30.0,
+    http2=False,
+    cassette=None,
+):
+    cassette = cassette or default_cassette
+
+    def make_transport(proxy=None):
+        # http2=True needs the optional h2 package (pip install httpx[http2])
+        transport = InstrumentedTransport(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+            proxy=proxy,
+        )
+        if cassette is not None:
+            transport = CassetteTransport(cassette, transport)
+        return transport
+
+    # Follow redirects like the SDK's own default client
+    http_client = httpx.Client(
+        transport=make_transport(),
+        mounts={
+            pattern: make_transport(proxy) if proxy else None
+            for pattern, proxy in environment_proxies().items()
+        },
+        timeout=httpx.Timeout(60.0, connect=5.0),
+        follow_redirects=True,
+    )
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session(pool_connections=10, pool_maxsize=20, cassette=None):
+    session = requests.Session()
+    cassette = cassette or default_cassette
+    if cassette is not None:
+        adapter = CassetteAdapter(
+            cassette, pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+    else:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.hooks["response"].append(telemetry.requests_hook)
+    return session
+
+
+def count_tokens_batch(texts, model="gpt-3.5-turbo", num_threads=8):
+    # tiktoken encodes the batch across a thread pool
+    encoded = get_encoding(model).encode_batch(
+        texts, num_threads=num_threads, disallowed_special=()
+    )
+    return [len(tokens) for tokens in encoded]
+
+
+def count_tool_tokens(tools, model="gpt-3.5-turbo"):
+    # Tool schemas are rendered into the prompt, per the OpenAI cookbook
+    num_tokens = 12
+    for tool in tools:
+        function = tool["function"]
+        description = function.get("description", "").removesuffix(".")
+        num_tokens += 7 + count_text_tokens(f"{function['name']}:{description}", model)
+        properties = function.get("parameters", {}).get("properties", {})
+        if properties:
+            num_tokens += 3
+        for name, schema in properties.items():
+            num_tokens += 3
+            for item in schema.get("enum", []):
+                num_tokens += 3 + count_text_tokens(str(item), model)
+            if "enum" in schema:
+                num_tokens -= 3
+            description = schema.get("description", "").removesuffix(".")
+            num_tokens += count_text_tokens(
+                f"{name}:{schema.get('type')}:{description}", model
+            )
+    return num_tokens
+
+
+def count_chat_tokens(messages, model="gpt-3.5-turbo", tools=None):
+    # Every reply is primed with 3 tokens and every message costs 3 more
+    num_tokens = 3
+    for message in messages:
+        if not isinstance(message, dict):
+            message = message.model_dump(exclude_none=True)
+        num_tokens += 3
+        for key, value in message.items():
+            if isinstance(value, str):
+                num_tokens += count_text_tokens(value, model)
+            if key == "name":
+                num_tokens += 1
+            if key == "tool_calls":
+                for tool_call in value:
+                    function = tool_call["function"]
+                    num_tokens += count_text_tokens(function["name"], model)
+                    num_tokens += count_text_tokens(function["arguments"], model)
+    if tools:
+        num_tokens += count_tool_tokens(tools, model)
+    return num_tokens
+
+
+def new_async_openai_client(cassette=None, **params):
+    # Async clients are bound to one event loop, so they are not shared
+    cassette = cassette or default_cassette
+
+    def make_transport(proxy=None):
+        transport = InstrumentedAsyncTransport(proxy=proxy)
+        if cassette is not None:
+            transport = CassetteTransport(cassette, transport)
+        return transport
+
+    http_client = httpx.AsyncClient(
+        transport=make_transport(),
+        mounts={
+            pattern: make_transport(proxy) if proxy else None
+            for pattern, proxy in environment_proxies().items()
+        },
+        follow_redirects=True,
+    )
+    return AsyncOpenAI(http_client=http_client, **params)
+
+
+async def get_response_async(
+    message_lists,
+    model="gpt-3.5-turbo",
+    max_concurrency=8,
+    timeout=30,
+    ordered=True,
+    client=None,
+    rate_limiter=None,
+):
+    client = client or new_async_openai_client()
+    # Cap the number of requests in flight at any time
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def complete(index, messages):
+        async with semaphore:
+            if rate_limiter is not None:
+                await rate_limiter.acquire_async(estimate_tokens(messages, model=model))
+            # Never wait past the caller's deadline, if one is set
+            request_timeout = remaining_time(timeout)
+            try:
+                with telemetry.track("get_response_async"):
+                    raw_response = await asyncio.wait_for(
+                        client.chat.completions.with_raw_response.create(
+                            model=model, messages=messages, timeout=request_timeout
+                        ),
+                        request_timeout,
+                    )
+            except openai.RateLimitError as e:
+                if rate_limiter is not None:
+                    rate_limiter.update_from_headers(e.response.headers)
+                raise
+            if rate_limiter is not None:
+                rate_limiter.update_from_headers(raw_response.headers)
+            return index, raw_response.parse().choices[0].message.content
+
+    tasks = [
+        asyncio.create_task(complete(index, messages))
+        for index, messages in enumerate(message_lists)
+    ]
+    try:
+        # Yield (index, content) pairs in input order or as they finish
+        for task in tasks if ordered else asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute, burst_seconds=6):
+        # Each bucket holds at most burst_seconds worth of its per-minute budget
+        self.rates = {
+            "requests": requests_per_minute / 60,
+            "tokens": tokens_per_minute / 60,
+        }
+        self.capacity = {key: rate * burst_seconds for key, rate in self.rates.items()}
+        self.available = dict(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        for key, rate in self.rates.items():
+            self.available[key] = min(
+                self.capacity[key], self.available[key] + elapsed * rate
+            )
+
+    def try_acquire(self, tokens):
+        # Return 0 if the request was admitted, otherwise the seconds to wait
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            cost = {"requests": 1, "tokens": tokens}
+            wait = 0.0
+            for key, amount in cost.items():
+                # Requests larger than a full bucket are admitted once it is full
+                needed = min(amount, self.capacity[key]) - self.available[key]
+                if needed > 0:
+                    wait = max(wait, needed / self.rates[key])
+            if wait == 0:
+                for key, amount in cost.items():
+                    self.available[key] -= amount
+            return wait
+
+    def acquire(self, tokens):
+        while (wait := self.try_acquire(tokens)) > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens):
+        while (wait := self.try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        with self.lock:
+            # Trust the server when it reports less budget than we think we have
+            for key in self.rates:
+                remaining = headers.get(f"x-ratelimit-remaining-{key}")
+                if remaining is not None:
+                    self.available[key] = min(self.available[key], float(remaining))
+            retry_after = retry_after_seconds(headers)
+            if retry_after is not None:
+                self.blocked_until = time.monotonic() + retry_after
+
+
+def retry_after_seconds(headers):
+    # retry-after-ms is OpenAI's own header; Retry-After is either a number of
+    # seconds or an HTTP date
+    try:
+        return float(headers["retry-after-ms"]) / 1000
+    except (KeyError, ValueError):
+        pass
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def estimate_tokens(
+    messages, max_completion_tokens=256, model="gpt-3.5-turbo", tools=None
+):
+    return count_chat_tokens(messages, model, tools) + max_completion_tokens
+
+
+def get_response_limited(
+    messages, rate_limiter, model="gpt-3.5-turbo", max_attempts=4, client=None
+):
+    # Let the limiter, not the SDK, decide when to retry
+    client = (client or get_openai_client()).with_options(max_retries=0)
+    tokens = estimate_tokens(messages, model=model)
+    for attempt in range(max_attempts):
+        rate_limiter.acquire(tokens)
+        try:
+            with telemetry.track("get_response"):
+                raw_response = client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=messages,
+                    timeout=remaining_time(openai.NOT_GIVEN),
+                )
+        except openai.RateLimitError as e:
+            rate_limiter.update_from_headers(e.response.headers)
+            if attempt == max_attempts - 1:
+                raise
+            continue
+        rate_limiter.update_from_headers(raw_response.headers)
+        return raw_response.parse().choices[0].message.content
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        path="response_cache.sqlite",
+        ttl=24 * 60 * 60,
+        max_entries=100000,
+        memory_entries=1000,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        # In-memory LRU of parsed responses in front of the on-disk store
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, body TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_created ON responses (created)"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def make_key(endpoint, params):
+        # Canonical JSON so equal payloads always hash to the same key
+        canonical = json.dumps(
+            {"endpoint": endpoint, **params},
+            sort_keys=True,
+            separators=(",", ":"),
+            default=lambda value: value.model_dump(),
+        )
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def get(self, key, response_type):
+        with self.lock:
+            now = time.time()
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            row = self.db.execute(
+                "SELECT body, created FROM responses WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            response = response_type.model_validate_json(row[0])
+            self._remember(key, row[1], response)
+            self.hits += 1
+            return response
+
+    def put(self, key, response):
+        with self.lock:
+            now = time.time()
+            self._remember(key, now, response)
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, body, created) VALUES (?, ?, ?)",
+                (key, response.model_dump_json(), now),
+            )
+            self.puts += 1
+            # Amortize eviction over many writes
+            if self.puts % 100 == 0:
+                self._evict(now)
+            self.db.commit()
+
+    def _remember(self, key, created, response):
+        self.memory[key] = (created, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _evict(self, now):
+        self.db.execute("DELETE FROM responses WHERE created <= ?", (now - self.ttl,))
+        self.db.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def cached_chat_completion(cache, client=None, **params):
+    key = cache.make_key("chat.completions", params)
+    response = cache.get(key, ChatCompletion)
+    if response is None:
+        with telemetry.track("cached_chat_completion"):
+            response = (client or get_openai_client()).chat.completions.create(**params)
+        cache.put(key, response)
+    return response
+
+
+def cached_moderation(cache, client=None, **params):
+    key = cache.make_key("moderations", params)
+    response = cache.get(key, ModerationCreateResponse)
+    if response is None:
+        with telemetry.track("cached_moderation"):
+            response = (client or get_openai_client()).moderations.create(**params)
+        cache.put(key, response)
+    return response
+
+
+def save_batch_state(state_path, state):
+    # Write atomically so a crash never leaves a half-written state file
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def write_batch_files(
+    items, build_messages, workdir, model, tools, max_requests_per_batch
+):
+    # Split into shards that respect the per-batch request limit
+    paths = []
+    items = iter(items)
+    while shard := list(itertools.islice(items, max_requests_per_batch)):
+        path = os.path.join(workdir, f"input_{len(paths)}.jsonl")
+        with open(path, "w") as f:
+            for custom_id, item in shard:
+                body = {"model": model, "messages": build_messages(item)}
+                if tools:
+                    body["tools"] = tools
+                request = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }
+                f.write(json.dumps(request) + "\n")
+        paths.append(path)
+    return paths
+
+
+def run_batch_pipeline(
+    items,
+    build_messages,
+    workdir,
+    model="gpt-3.5-turbo",
+    tools=None,
+    max_requests_per_batch=50000,
+    poll_interval=60,
+    client=None,
+):
+    client = client or get_openai_client()
+    os.makedirs(workdir, exist_ok=True)
+    state_path = os.path.join(workdir, "batch_state.json")
+    if os.path.exists(state_path):
+        # Resume where a previous run stopped
+        with open(state_path) as f:
+            state = json.load(f)
+    else:
+        paths = write_batch_files(
+            items, build_messages, workdir, model, tools, max_requests_per_batch
+        )
+        state = {"shards": [{"input": path} for path in paths]}
+        save_batch_state(state_path, state)
+
+    # Submit every shard before polling so they run side by side
+    for shard in state["shards"]:
+        if "file_id" not in shard:
+            with open(shard["input"], "rb") as f:
+                uploaded = client.files.create(file=f, purpose="batch")
+            shard["file_id"] = uploaded.id
+            shard["uploaded_at"] = uploaded.created_at
+            save_batch_state(state_path, state)
+        if "batch_id" not in shard:
+            # A crash between creating the batch and saving its id must not
+            # submit the shard twice, so reuse a batch already reading this file
+            batch = find_batch(client, shard["file_id"], shard.get("uploaded_at", 0))
+            if batch is None:
+                batch = client.batches.create(
+                    input_file_id=shard["file_id"],
+                    endpoint="/v1/chat/completions",
+                    completion_window="24h",
+                    metadata={"input": os.path.basename(shard["input"])},
+                )
+            shard["batch_id"] = batch.id
+            save_batch_state(state_path, state)
+
+    for shard in state["shards"]:
+        if "status" in shard:
+            continue
+        while True:
+            batch = client.batches.retrieve(shard["batch_id"])
+            if batch.status in ["completed", "failed", "expired", "cancelled"]:
+                break
+            time.sleep(poll_interval)
+        # Keep going when one shard fails; its requests are reported as errors
+        if batch.status != "completed":
+            errors = batch.errors.data if batch.errors and batch.errors.data else []
+            shard["error"] = "; ".join(error.message or "" for error in errors)
+            logging.warning(
+                "batch %s for %s ended with status %s",
+                batch.id,
+                shard["input"],
+                batch.status,
+            )
+        # Expired and cancelled batches can still have partial results
+        if batch.output_file_id:
+            shard["output"] = download_batch_file(
+                client,
+                batch.output_file_id,
+                shard["input"].replace("input_", "output_"),
+            )
+        if batch.error_file_id:
+            shard["errors"] = download_batch_file(
+                client, batch.error_file_id, shard["input"].replace("input_", "errors_")
+            )
+        shard["status"] = batch.status
+        save_batch_state(state_path, state)
+
+    for shard in state["shards"]:
+        yield from join_batch_results(
+            shard["input"],
+            shard.get("output"),
+            shard.get("errors"),
+            shard["status"],
+            shard.get("error"),
+        )
+
+
+def find_batch(client, file_id, uploaded_at):
+    # Batches are listed newest first; none can predate the upload of its input
+    for batch in client.batches.list(limit=100):
+        if batch.input_file_id == file_id:
+            return batch
+        if batch.created_at < uploaded_at:
+            return None
+    return None
+
+
+def download_batch_file(client, file_id, path):
+    with client.files.with_streaming_response.content(file_id) as response:
+        response.stream_to_file(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def join_batch_results(
+    input_path, output_path=None, error_path=None, status="completed", message=None
+):
+    # Output and error lines come back in any order, so index them by custom_id
+    results = {}
+    for path in [output_path, error_path]:
+        if path is None:
+            continue
+        with open(path) as f:
+            for line in f:
+                result = json.loads(line)
+                results[result["custom_id"]] = result
+    # Yield (custom_id, body, response, error) with exactly one of the last two set
+    with open(input_path) as f:
+        for line in f:
+            request = json.loads(line)
+            result = results.get(request["custom_id"])
+            if result is None:
+                error = {"code": f"batch_{status}", "message": message}
+                yield request["custom_id"], request["body"], None, error
+            elif result["error"] is not None:
+                yield request["custom_id"], request["body"], None, result["error"]
+            elif result["response"]["status_code"] != 200:
+                error = result["response"]["body"].get("error")
+                yield request["custom_id"], request["body"], None, error
+            else:
+                response = ChatCompletion.model_validate(result["response"]["body"])
+                yield request["custom_id"], request["body"], response, None
+
+
+class IncrementalObjectParser:
+    # Emit top-level fields of a JSON object as soon as each value is complete.
+    # Only the fragments of the field being read are kept, and they are joined
+    # once when it completes, so long bodies decode in linear time.
+    def __init__(self):
+        self.chunks = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+
+    def feed(self, fragment):
+        self.started = self.started or bool(fragment.strip())
+        fields = []
+        field_start = 0
+        for index, char in enumerate(fragment):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.chunks = []
+                    field_start = index + 1
+            elif char in "}]" or (char == "," and self.depth == 1):
+                if self.depth == 1:
+                    self.chunks.append(fragment[field_start:index])
+                    segment = "".join(self.chunks).strip()
+                    self.chunks = []
+                    if segment:
+                        fields.append(json.loads("{" + segment + "}").popitem())
+                    field_start = index + 1
+                if char != ",":
+                    self.depth -= 1
+        if self.depth:
+            self.chunks.append(fragment[field_start:])
+        return fields
+
+
+def stream_response(messages, model="gpt-3.5-turbo", client=None, **params):
+    # Yield ("content", text), ("tool_call", (index, name)),
+    # ("field", (index, key, value)) and finally ("metrics", metrics)
+    client = client or get_openai_client()
+    metrics = {"time_to_first_token": None, "time_to_first_field": None}
+    parsers = {}
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
+        model=model, messages=messages, stream=True, **params
+    )
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if metrics["time_to_first_token"] is None and (
+            delta.content or delta.tool_calls
+        ):
+            metrics["time_to_first_token"] = time.perf_counter() - start
+        if delta.content:
+            yield "content", delta.content
+        for tool_call in delta.tool_calls or []:
+            if tool_call.index not in parsers:
+                parsers[tool_call.index] = IncrementalObjectParser()
+                yield "tool_call", (tool_call.index, tool_call.function.name)
+            fragment = tool_call.function.arguments or ""
+            for key, value in parsers[tool_call.index].feed(fragment):
+                if metrics["time_to_first_field"] is None:
+                    metrics["time_to_first_field"] = time.perf_counter() - start
+                yield "field", (tool_call.index, key, value)
+    metrics["total_time"] = time.perf_counter() - start
+    yield "metrics", metrics
+
+
+def chunk_text(text, max_tokens, overlap=50, model="gpt-3.5-turbo"):
+    # Split on token boundaries with a small overlap between chunks
+    if max_tokens <= overlap:
+        raise ValueError("The chunk size must be larger than the overlap")
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    step = max_tokens - overlap
+    return [
+        encoding.decode(tokens[start : start + max_tokens])
+        for start in range(0, max(len(tokens) - overlap, 1), step)
+    ]
+
+
+def truncate_messages(messages, max_tokens, model="gpt-3.5-turbo", tools=None):
+    # Trim the end of the last user message until the payload fits the budget
+    overflow = count_chat_tokens(messages, model, tools) - max_tokens
+    if overflow <= 0:
+        return messages
+    index = max(i for i, message in enumerate(messages) if message["role"] == "user")
+    encoding = get_encoding(model)
+    tokens = encoding.encode(messages[index]["content"], disallowed_special=())
+    if overflow >= len(tokens):
+        raise ValueError("The token budget is too small for the fixed messages")
+    truncated = {**messages[index], "content": encoding.decode(tokens[:-overflow])}
+    return messages[:index] + [truncated] + messages[index + 1 :]
+
+
+def merge_extractions(results):
+    # Keep the first non-empty value of each field, in chunk order
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if key not in merged and value not in [None, "", []]:
+                merged[key] = value
+    return merged
+
+
+def extract_from_long_text(
+    messages,
+    tools,
+    max_prompt_tokens=1000,
+    overlap=50,
+    max_workers=8,
+    timeout=30,
+    model="gpt-3.5-turbo",
+    client=None,
+):
+    client = (client or get_openai_client()).with_options(timeout=timeout)
+    name = tools[0]["function"]["name"]
+    fixed = messages[:-1] + [{"role": "user", "content": ""}]
+    chunk_budget = max_prompt_tokens - count_chat_tokens(fixed, model, tools)
+    if chunk_budget <= overlap:
+        raise ValueError("The token budget is too small for the fixed messages")
+    chunks = chunk_text(messages[-1]["content"], chunk_budget, overlap, model)
+
+    def extract(chunk):
+        with telemetry.track("extract_from_long_text"):
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages[:-1] + [{"role": "user", "content": chunk}],
+                tools=tools,
+                tool_choice={"type": "function", "function": {"name": name}},
+            )
+        return json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+
+    # Map over the chunks in parallel, then reduce into a single result
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return merge_extractions(executor.map(extract, chunks))
+
+
+tool_registry = {}
+
+
+def register_tool(name=None, timeout=10):
+    def decorator(function):
+        tool_registry[name or function.__name__] = (function, timeout)
+        return function
+
+    return decorator
+
+
+async def run_tool_call(tool_call):
+    name = tool_call.function.name
+    if name not in tool_registry:
+        content = {"error": f"Unknown tool {name}"}
+    else:
+        function, timeout = tool_registry[name]
+        try:
+            timeout = remaining_time(timeout)
+            arguments = json.loads(tool_call.function.arguments)
+            # Run sync tools in a worker thread so they do not block the others
+            if asyncio.iscoroutinefunction(function):
+                call = function(**arguments)
+            else:
+                call = asyncio.to_thread(function, **arguments)
+            content = await asyncio.wait_for(call, timeout)
+        except asyncio.TimeoutError:
+            content = {"error": f"{name} timed out after {timeout}s"}
+        except Exception as e:
+            content = {"error": str(e)}
+    if not isinstance(content, str):
+        content = json.dumps(content)
+    return {"role": "tool", "tool_call_id": tool_call.id, "content": content}
+
+
+async def dispatch_tool_calls(tool_calls):
+    return await asyncio.gather(*(run_tool_call(call) for call in tool_calls))
+
+
+def complete_with_tools(
+    messages, tools, model="gpt-3.5-turbo", max_rounds=5, client=None
+):
+    client = client or get_openai_client()
+    messages = list(messages)
+    for i in range(max_rounds):
+        with telemetry.track("complete_with_tools"):
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=tools,
+                timeout=remaining_time(openai.NOT_GIVEN),
+            )
+        if response.choices[0].finish_reason != "tool_calls":
+            break
+        # Execute every tool call at once and feed the results back
+        message = response.choices[0].message
+        messages.append(message.model_dump(exclude_none=True))
+        messages.extend(asyncio.run(dispatch_tool_calls(message.tool_calls)))
+    return response
+
+
+class AirportCache:
+    def __init__(
+        self,
+        url="https://api.aviationapi.com/v1/airports",
+        ttl=24 * 60 * 60,
+        stale_ttl=7 * 24 * 60 * 60,
+    ):
+        self.url = url
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = {}
+        # One shared future per code being fetched, so callers never duplicate work
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.refresher = ThreadPoolExecutor(max_workers=4)
+
+    def _fetch(self, codes, future):
+        try:
+            with telemetry.track("get_airport_info"):
+                response = get_http_session().get(
+                    self.url,
+                    params={"apt": ",".join(codes)},
+                    timeout=remaining_time(10),
+                )
+            response.raise_for_status()
+            data = response.json()
+            fetched_at = time.monotonic()
+            with self.lock:
+                for code in codes:
+                    self.entries[code] = (fetched_at, data.get(code))
+            future.set_result(data)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                for code in codes:
+                    if self.in_flight.get(code) is future:
+                        del self.in_flight[code]
+
+    def get_many(self, airport_codes):
+        results = {}
+        waiting = {}
+        missing = []
+        stale = []
+        with self.lock:
+            now = time.monotonic()
+            for code in dict.fromkeys(code.upper() for code in airport_codes):
+                entry = self.entries.get(code)
+                age = now - entry[0] if entry else None
+                if entry and age < self.stale_ttl:
+                    results[code] = entry[1]
+                    # Serve stale entries while refreshing them in the background
+                    if age >= self.ttl and code not in self.in_flight:
+                        stale.append(code)
+                elif code in self.in_flight:
+                    waiting[code] = self.in_flight[code]
+                else:
+                    missing.append(code)
+            missing_future = Future()
+            stale_future = Future()
+            self.in_flight.update({code: missing_future for code in missing})
+            self.in_flight.update({code: stale_future for code in stale})
+        if stale:
+            self.refresher.submit(self._fetch, stale, stale_future)
+        if missing:
+            # One bulk request for every code nobody else is fetching
+            self._fetch(missing, missing_future)
+            waiting.update({code: missing_future for code in missing})
+        for code, future in waiting.items():
+            results[code] = future.result().get(code)
+        return results
+
+    def get_airport_info(self, airport_code):
+        return json.dumps(self.get_many([airport_code]))
+
+
+class ModerationGate:
+    def __init__(
+        self,
+        client=None,
+        max_batch_size=32,
+        max_wait=0.01,
+        cache_size=10000,
+        cache_ttl=60 * 60,
+    ):
+        self.client = client or get_openai_client()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        # Recent verdicts, keyed by a hash of the input text
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        threading.Thread(target=self._collect_batches, daemon=True).start()
+
+    def _cached(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None or time.monotonic() - entry[0] >= self.cache_ttl:
+                return None
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def _remember(self, key, result):
+        with self.lock:
+            self.cache[key] = (time.monotonic(), result)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def moderate_many(self, texts):
+        keys = [hashlib.sha256(text.encode()).hexdigest() for text in texts]
+        results = {key: self._cached(key) for key in keys}
+        texts_by_key = dict(zip(keys, texts))
+        missing = [
+            (key, text) for key, text in texts_by_key.items() if results[key] is None
+        ]
+        # The moderations endpoint accepts a list, so send many inputs per call
+        for start in range(0, len(missing), self.max_batch_size):
+            chunk = missing[start : start + self.max_batch_size]
+            with telemetry.track("moderation"):
+                response = self.client.moderations.create(
+                    input=[text for _, text in chunk]
+                )
+            for (key, _), result in zip(chunk, response.results):
+                results[key] = result
+                self._remember(key, result)
+        return [results[key] for key in keys]
+
+    def submit(self, text):
+        # Queue one input to be sent with others arriving at the same time
+        future = Future()
+        self.pending.put((text, future))
+        return future
+
+    def moderate(self, text):
+        return self.submit(text).result()
+
+    def _collect_batches(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(
+                        self.pending.get(timeout=max(deadline - time.monotonic(), 0))
+                    )
+                except queue.Empty:
+                    break
+            try:
+                results = self.moderate_many([text for text, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+
+def moderated_completion(
+    messages, gate, model="gpt-3.5-turbo", speculative=True, client=None
+):
+    client = client or get_openai_client()
+    user_texts = [m["content"] for m in messages if m["role"] == "user"]
+    if not speculative:
+        if any(result.flagged for result in gate.moderate_many(user_texts)):
+            return None
+        with telemetry.track("moderated_completion"):
+            return client.chat.completions.create(model=model, messages=messages)
+    # Run moderation alongside the completion and drop the answer if flagged
+    verdicts = [gate.submit(text) for text in user_texts]
+    with telemetry.track("moderated_completion"):
+        response = client.chat.completions.create(model=model, messages=messages)
+    if any(verdict.result().flagged for verdict in verdicts):
+        return None
+    return response
+
+
+def get_tool_validators(tools):
+    # Keyed by the schema's contents, so a schema edited in place gets a new
+    # validator; callers that reuse the same tools can hold on to the result
+    return {
+        tool["function"]["name"]: get_validator(
+            json.dumps(tool["function"]["parameters"], sort_keys=True)
+        )
+        for tool in tools
+    }
+
+
+def parse_tool_arguments(tool_call, tools, validators=None):
+    if validators is None:
+        validators = get_tool_validators(tools)
+    validator = validators.get(tool_call.function.name)
+    if validator is None:
+        raise ValidationError(f"unknown tool {tool_call.function.name}")
+    try:
+        arguments = loads_json(tool_call.function.arguments)
+    except ValueError as e:
+        raise ValidationError(f"arguments are not valid JSON: {e}")
+    validator(arguments)
+    return arguments
+
+
+def get_validated_arguments(
+    messages, tools, model="gpt-3.5-turbo", max_reasks=1, client=None, **params
+):
+    client = client or get_openai_client()
+    messages = list(messages)
+    validators = get_tool_validators(tools)
+    for attempt in range(max_reasks + 1):
+        with telemetry.track("get_validated_arguments"):
+            response = client.chat.completions.create(
+                model=model, messages=messages, tools=tools, **params
+            )
+        message = response.choices[0].message
+        errors = {}
+        results = []
+        for tool_call in message.tool_calls or []:
+            try:
+                results.append(
+                    (
+                        tool_call.function.name,
+                        parse_tool_arguments(tool_call, tools, validators),
+                    )
+                )
+            except ValidationError as e:
+                errors[tool_call.id] = str(e)
+        if not errors:
+            return results
+        # Re-ask with the specific problems instead of starting over
+        messages.append(message.model_dump(exclude_none=True))
+        for tool_call in message.tool_calls:
+            content = errors.get(tool_call.id, "OK")
+            if tool_call.id in errors:
+                content = f"Invalid arguments: {content}. Call {tool_call.function.name} again with corrected arguments."
+            messages.append(
+                {"role": "tool", "tool_call_id": tool_call.id, "content": content}
+            )
+    raise ValidationError("; ".join(errors.values()))
+
+
+def decode_value(value, decoder):
+    if decoder is None:
+        return value
+    if isinstance(value, list):
+        return [decode_value(item, decoder) for item in value]
+    # Drop fields the schema allows but the dataclass does not declare
+    if dataclasses.is_dataclass(decoder):
+        names = {field.name for field in dataclasses.fields(decoder)}
+        value = {key: item for key, item in value.items() if key in names}
+    return decoder(**value)
+
+
+def stream_structured_response(
+    messages, schema, decoders=None, model="gpt-3.5-turbo", client=None
+):
+    # Yield (field, decoded value) pairs as soon as each top-level field arrives
+    client = client or get_openai_client()
+    decoders = decoders or {}
+    validators = {
+        name: compile_schema(subschema, name)
+        for name, subschema in schema.get("properties", {}).items()
+    }
+    schema_message = {
+        "role": "system",
+        "content": "Respond with a JSON object that matches this JSON schema: "
+        + json.dumps(schema),
+    }
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[schema_message] + list(messages),
+        response_format={"type": "json_object"},
+        stream=True,
+    )
+    parser = IncrementalObjectParser()
+    seen = set()
+    try:
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            content = chunk.choices[0].delta.content
+            # Reject anything that is not a JSON object from the first character
+            if not parser.started and content.strip()[:1] not in ["", "{"]:
+                raise ValidationError("response is not a JSON object")
+            for name, value in parser.feed(content):
+                if name in validators:
+                    validators[name](value)
+                seen.add(name)
+                yield name, decode_value(value, decoders.get(name))
+    except json.JSONDecodeError as e:
+        raise ValidationError(f"response is not valid JSON: {e}")
+    finally:
+        stream.close()
+    if parser.depth != 0 or not parser.started:
+        raise ValidationError("response ended before the JSON object was complete")
+    missing = set(schema.get("required", [])) - seen
+    if missing:
+        raise ValidationError(f"response is missing {sorted(missing)}")
+
+
+def get_structured_response(messages, schema, decoders=None, **params):
+    return dict(stream_structured_response(messages, schema, decoders, **params))
+
+
+def canonical_json(value):
+    # Rebuild with sorted keys so the SDK always serializes identical bytes
+    return json.loads(json.dumps(value, sort_keys=True, separators=(",", ":")))
+
+
+def cached_prompt_tokens(response):
+    details = getattr(response.usage, "prompt_tokens_details", None) or {}
+    if not isinstance(details, dict):
+        details = details.model_dump()
+    return details.get("cached_tokens") or 0
+
+
+class PromptBuilder:
+    def __init__(self, system_prompts, tools=None):
+        # The static prefix is built once and reused byte for byte
+        self.prefix = [
+            {"role": "system", "content": prompt} for prompt in system_prompts
+        ]
+        self.tools = canonical_json(tools) if tools else None
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def build(self, messages):
+        # Static system prompts first, then request-specific system messages,
+        # then the conversation, so late system messages never split the prefix
+        static = {message["content"] for message in self.prefix}
+        extra_system = [
+            message
+            for message in messages
+            if message["role"] == "system" and message["content"] not in static
+        ]
+        conversation = [message for message in messages if message["role"] != "system"]
+        params = {"messages": self.prefix + extra_system + conversation}
+        if self.tools:
+            params["tools"] = self.tools
+        return params
+
+    def create(self, messages, model="gpt-3.5-turbo", client=None, **params):
+        client = client or get_openai_client()
+        response = client.chat.completions.create(
+            model=model, **self.build(messages), **params
+        )
+        self.prompt_tokens += response.usage.prompt_tokens
+        self.cached_tokens += cached_prompt_tokens(response)
+        return response
+
+    def cache_report(self):
+        ratio = self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_ratio": round(ratio, 3),
+        }
+
+
+# Quality tier, context window and typical latency in seconds for each model
+MODEL_TABLE = [
+    {"model": "gpt-4o-mini", "quality": 2, "context_window": 128000, "latency": 0.5},
+    {"model": "gpt-3.5-turbo", "quality": 1, "context_window": 16385, "latency": 0.6},
+    {"model": "gpt-4o", "quality": 3, "context_window": 128000, "latency": 1.0},
+]
+# Minimum quality tier each kind of task needs
+TASK_QUALITY = {
+    "extraction": 1,
+    "classification": 1,
+    "function_calling": 2,
+    "reasoning": 3,
+}
+
+
+class ModelRouter:
+    def __init__(self, models=MODEL_TABLE, task_quality=TASK_QUALITY):
+        # Sort once by price, then latency, so each decision is a short scan
+        self.models = sorted(
+            models, key=lambda m: (sum(model_price(m["model"])), m["latency"])
+        )
+        self.task_quality = task_quality
+        self.decisions = deque(maxlen=1000)
+        self.logger = logging.getLogger("model_router")
+
+    def choose(self, task, input_tokens, min_quality=None, max_completion_tokens=512):
+        quality = min_quality or self.task_quality.get(task, 2)
+        for model in self.models:
+            if (
+                model["quality"] >= quality
+                and input_tokens + max_completion_tokens <= model["context_window"]
+            ):
+                return model
+        raise ValueError(f"No model meets quality {quality} for {input_tokens} tokens")
+
+    def route(self, task, messages, validate=None, client=None, **params):
+        # Start with the cheapest suitable model and escalate when validation fails
+        client = client or get_openai_client()
+        input_tokens = count_chat_tokens(messages, tools=params.get("tools"))
+        quality = None
+        while True:
+            model = self.choose(task, input_tokens, quality)
+            start = time.perf_counter()
+            with telemetry.track(f"router:{task}"):
+                response = client.chat.completions.create(
+                    model=model["model"], messages=messages, **params
+                )
+            prompt_price, completion_price = model_price(model["model"])
+            decision = {
+                "task": task,
+                "model": model["model"],
+                "input_tokens": input_tokens,
+                "latency": time.perf_counter() - start,
+                "cost": (
+                    response.usage.prompt_tokens * prompt_price
+                    + response.usage.completion_tokens * completion_price
+                )
+                / 1e6,
+                "valid": True,
+            }
+            try:
+                if validate is not None:
+                    validate(response)
+                return response
+            except ValidationError:
+                decision["valid"] = False
+                quality = model["quality"] + 1
+                if quality > max(m["quality"] for m in self.models):
+                    raise
+            finally:
+                self.decisions.append(decision)
+                self.logger.info("routing decision: %s", decision)
+
+
+class HedgePolicy:
+    def __init__(self, percentile=0.9, max_hedge_ratio=0.1, min_delay=0.01, warmup=20):
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_delay = min_delay
+        self.warmup = warmup
+        self.histogram = LatencyHistogram()
+        self.requests = 0
+        self.hedges = 0
+
+    def hedge_delay(self):
+        # Only hedge once enough latencies are known to estimate the percentile
+        if self.histogram.count < self.warmup:
+            return None
+        return max(self.histogram.percentile(self.percentile), self.min_delay)
+
+    def try_hedge(self):
+        # Cap duplicates to a share of all requests so spend cannot multiply
+        if self.hedges >= self.max_hedge_ratio * self.requests:
+            return False
+        self.hedges += 1
+        return True
+
+
+async def hedged_create(policy, client, **params):
+    policy.requests += 1
+
+    async def attempt():
+        start = time.perf_counter()
+        response = await client.chat.completions.create(
+            timeout=remaining_time(openai.NOT_GIVEN), **params
+        )
+        policy.histogram.record(time.perf_counter() - start)
+        return response
+
+    tasks = [asyncio.create_task(attempt())]
+    try:
+        hedge_delay = policy.hedge_delay()
+        if hedge_delay is not None:
+            done, pending = await asyncio.wait(
+                tasks, timeout=remaining_time(hedge_delay)
+            )
+            if not done and policy.try_hedge():
+                tasks.append(asyncio.create_task(attempt()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=remaining_time(),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                raise DeadlineExceeded("The request deadline has passed")
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+        # Every attempt failed, so surface the first error
+        return tasks[0].result()
+    finally:
+        # Cancel the losers and wait for them so no request is left running
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def get_response_hedged(
+    messages, policy, model="gpt-3.5-turbo", timeout=None, client=None
+):
+    client = client or new_async_openai_client()
+    with contextlib.ExitStack() as stack:
+        if timeout is not None:
+            stack.enter_context(deadline(timeout))
+        response = await hedged_create(policy, client, model=model, messages=messages)
+    return response.choices[0].message.content
+
+
+class ConversationStore:
+    def __init__(self, path="conversations.sqlite"):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # One row per turn, so saving a turn never rewrites the history
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS turns (user_id TEXT NOT NULL, "
+            "seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, "
+            "tokens INTEGER NOT NULL, PRIMARY KEY (user_id, seq))"
+        )
+        self.db.commit()
+
+    def load(self, user_id):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT seq, role, content, tokens FROM turns "
+                "WHERE user_id = ? ORDER BY seq",
+                (user_id,),
+            ).fetchall()
+        return [dict(zip(["seq", "role", "content", "tokens"], row)) for row in rows]
+
+    def append(self, user_id, turn):
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO turns (user_id, seq, role, content, tokens) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user_id, turn["seq"], turn["role"], turn["content"], turn["tokens"]),
+            )
+            self.db.commit()
+
+    def replace_before(self, user_id, summary):
+        # Swap every turn up to the summary's position for the summary itself
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM turns WHERE user_id = ? AND seq <= ?",
+                (user_id, summary["seq"]),
+            )
+            self.db.execute(
+                "INSERT INTO turns (user_id, seq, role, content, tokens) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    user_id,
+                    summary["seq"],
+                    summary["role"],
+                    summary["content"],
+                    summary["tokens"],
+                ),
+            )
+            self.db.commit()
+
+
+class Conversation:
+    def __init__(
+        self,
+        user_id,
+        system_prompt,
+        store,
+        token_budget=2000,
+        keep_recent=4,
+        model="gpt-3.5-turbo",
+    ):
+        self.user_id = user_id
+        self.system_prompt = system_prompt
+        self.store = store
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.model = model
+        self.turns = store.load(user_id)
+        # Running total, so each new turn only tokenizes the new message
+        self.token_count = count_chat_tokens(
+            [{"role": "system", "content": system_prompt}], model
+        ) + sum(turn["tokens"] for turn in self.turns)
+
+    def append(self, role, content, tokens=None):
+        turn = {
+            "seq": self.turns[-1]["seq"] + 1 if self.turns else 0,
+            "role": role,
+            "content": content,
+            "tokens": tokens or count_text_tokens(content, self.model) + 3,
+        }
+        self.turns.append(turn)
+        self.token_count += turn["tokens"]
+        self.store.append(self.user_id, turn)
+
+    def messages(self):
+        return [{"role": "system", "content": self.system_prompt}] + [
+            {"role": turn["role"], "content": turn["content"]} for turn in self.turns
+        ]
+
+    def summarize(self, client, old):
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in old)
+        with telemetry.track("conversation_summary"):
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Summarize this conversation in a few sentences, keeping every fact needed to continue it.",
+                    },
+                    {"role": "user", "content": transcript},
+                ],
+            )
+        content = "Summary of the earlier conversation: "
+        content += response.choices[0].message.content
+        summary = {
+            "seq": old[-1]["seq"],
+            "role": "system",
+            "content": content,
+            "tokens": count_text_tokens(content, self.model) + 3,
+        }
+        self.store.replace_before(self.user_id, summary)
+        self.turns = [summary] + self.turns[len(old) :]
+        self.token_count += summary["tokens"] - sum(turn["tokens"] for turn in old)
+
+    def compact(self, client, reserve=0):
+        # Summarize the older turns, folding in recent ones as well while the
+        # conversation plus `reserve` tokens is still over budget
+        keep = min(self.keep_recent, len(self.turns))
+        while self.token_count + reserve > self.token_budget:
+            old = self.turns[: len(self.turns) - keep]
+            # A lone summary would only be summarized again
+            if len(old) > 1 or (old and old[0]["role"] != "system"):
+                self.summarize(client, old)
+            elif keep:
+                keep -= 1
+            else:
+                raise ValueError("The conversation does not fit the token budget")
+
+    def send(self, content, client=None, **params):
+        client = client or get_openai_client()
+        # Make room before adding the new message, so it is always sent verbatim
+        tokens = count_text_tokens(content, self.model) + 3
+        if self.token_count + tokens > self.token_budget:
+            self.compact(client, reserve=tokens)
+        self.append("user", content, tokens)
+        with telemetry.track("conversation"):
+            response = client.chat.completions.create(
+                model=self.model,
+                messages=self.messages(),
+                user=self.user_id,
+                **params,
+            )
+        reply = response.choices[0].message.content
+        self.append("assistant", reply)
+        return reply
+
+
+class NumpyIndex:
+    # Brute-force cosine search over a preallocated matrix of unit vectors.
+    # Any object with the same add/remove/search(vector, slots) methods can
+    # replace it, e.g. a wrapper around an approximate nearest neighbour library.
+    def __init__(self, dimensions, capacity):
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.used = np.zeros(capacity, dtype=bool)
+
+    def add(self, slot, vector):
+        self.vectors[slot] = vector
+        self.used[slot] = True
+
+    def remove(self, slot):
+        self.used[slot] = False
+
+    def search(self, vector, slots=None):
+        # Restrict the search to the given slots when they are passed
+        if slots is not None:
+            slots = np.fromiter(slots, dtype=np.intp)
+            scores = self.vectors[slots] @ vector
+            best = int(np.argmax(scores))
+            return int(slots[best]), float(scores[best])
+        scores = self.vectors @ vector
+        scores[~self.used] = -1.0
+        slot = int(np.argmax(scores))
+        return slot, float(scores[slot])
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        threshold=0.9,
+        capacity=10000,
+        dimensions=256,
+        embedding_model="text-embedding-3-small",
+        index=None,
+        client=None,
+    ):
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self.embedding_model = embedding_model
+        self.client = client or get_openai_client()
+        # Memory is bounded by capacity * dimensions floats plus the answers
+        self.index = index or NumpyIndex(dimensions, capacity)
+        self.answers = OrderedDict()
+        self.context_slots = defaultdict(set)
+        self.free_slots = list(range(capacity))
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed(self, text):
+        with telemetry.track("semantic_cache_embedding"):
+            response = self.client.embeddings.create(
+                model=self.embedding_model, input=text, dimensions=self.dimensions
+            )
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, vector, context):
+        with self.lock:
+            # Only questions asked under the same system prompt are candidates
+            slots = self.context_slots.get(context)
+            if not slots:
+                return None
+            slot, score = self.index.search(vector, slots)
+            if score < self.threshold:
+                return None
+            self.answers.move_to_end(slot)
+            return self.answers[slot][1]
+
+    def store(self, vector, context, answer):
+        with self.lock:
+            if not self.free_slots:
+                # Evict the least recently used answer
+                slot, (evicted_context, _) = self.answers.popitem(last=False)
+                self.index.remove(slot)
+                self.context_slots[evicted_context].discard(slot)
+                if not self.context_slots[evicted_context]:
+                    del self.context_slots[evicted_context]
+                self.free_slots.append(slot)
+            slot = self.free_slots.pop()
+            self.index.add(slot, vector)
+            self.answers[slot] = (context, answer)
+            self.context_slots[context].add(slot)
+
+    def get_response(self, messages, model="gpt-3.5-turbo", client=None, **params):
+        # Embed only the latest message; everything before it must match exactly
+        context = hashlib.sha256(
+            json.dumps(messages[:-1], sort_keys=True).encode()
+        ).hexdigest()
+        vector = self.embed(messages[-1]["content"])
+        answer = self.lookup(vector, context)
+        if answer is not None:
+            self.hits += 1
+            return answer
+        self.misses += 1
+        client = client or get_openai_client()
+        with telemetry.track("semantic_cache_completion"):
+            response = client.chat.completions.create(
+                model=model, messages=messages, **params
+            )
+        answer = response.choices[0].message.content
+        self.store(vector, context, answer)
+        return answer
+
+
+def packed_tools(name, description, item_schema):
+    # Wrap a per-item result schema in an array keyed by input index
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": name,
+                "description": description,
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "results": {
+                            "type": "array",
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "index": {
+                                        "type": "integer",
+                                        "description": "Index of the input item",
+                                    },
+                                    **item_schema["properties"],
+                                },
+                                "required": ["index", *item_schema.get("required", [])],
+                            },
+                        }
+                    },
+                    "required": ["results"],
+                },
+            },
+        }
+    ]
+
+
+def pack_items(texts, max_item_tokens=1000, max_items=20, model="gpt-3.5-turbo"):
+    # Greedily fill each request up to the token budget or the item cap
+    batches, batch, budget = [], [], 0
+    for index, tokens in enumerate(count_tokens_batch(texts, model)):
+        # Each item is wrapped as {"index": n, "text": ...} on its own line
+        tokens += 10
+        if batch and (budget + tokens > max_item_tokens or len(batch) == max_items):
+            batches.append(batch)
+            batch, budget = [], 0
+        batch.append(index)
+        budget += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def classify_packed(
+    texts,
+    instructions,
+    item_schema,
+    name="classify_items",
+    max_item_tokens=1000,
+    max_items=20,
+    max_workers=4,
+    model="gpt-3.5-turbo",
+    client=None,
+):
+    client = client or get_openai_client()
+    tools = packed_tools(name, instructions, item_schema)
+    validators = get_tool_validators(tools)
+    system_prompt = (
+        instructions
+        + " Each line of the user message is a JSON item with an index and a text. Return exactly one result per item, with the same index."
+    )
+
+    def classify(batch):
+        items = "\n".join(
+            json.dumps({"index": index, "text": texts[index]}) for index in batch
+        )
+        try:
+            with telemetry.track("classify_packed"):
+                response = client.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": items},
+                    ],
+                    tools=tools,
+                    tool_choice={"type": "function", "function": {"name": name}},
+                )
+        except openai.APIError as e:
+            # A failed packed request falls back to single requests like a
+            # malformed one; a failed single request leaves its result None
+            logging.warning("packed %s request failed: %s", name, e)
+            return {}
+        try:
+            arguments = parse_tool_arguments(
+                response.choices[0].message.tool_calls[0], tools, validators
+            )
+        except (ValidationError, IndexError, TypeError) as e:
+            logging.warning("packed %s request failed: %s", name, e)
+            return {}
+        # Keep only results whose index maps back to exactly one input item
+        counts = Counter(result["index"] for result in arguments["results"])
+        return {
+            result.pop("index"): result
+            for result in arguments["results"]
+            if result["index"] in batch and counts[result["index"]] == 1
+        }
+
+    results = [None] * len(texts)
+    batches = pack_items(texts, max_item_tokens, max_items, model)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch, answers in zip(batches, executor.map(classify, batches)):
+            for index, answer in answers.items():
+                results[index] = answer
+        # Items that went missing or came back malformed are retried one by one
+        missing = [[index] for index, result in enumerate(results) if result is None]
+        for batch, answers in zip(missing, executor.map(classify, missing)):
+            results[batch[0]] = answers.get(batch[0])
+    return results
+
+
+class UpstreamUnavailable(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                # Let a single probe through to test whether the endpoint recovered
+                self.state = "half_open"
+                return True
+            return self.state == "closed"
+
+    def record(self, ok):
+        with self.lock:
+            if ok:
+                self.state = "closed"
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class AdaptiveLimit:
+    # Additive increase, multiplicative decrease, as in TCP congestion control
+    def __init__(
+        self, initial=4, min_limit=1, max_limit=64, latency_target=2.0, decrease=0.5
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: self.in_flight < int(self.limit), timeout
+            ):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency=None, ok=None):
+        with self.condition:
+            self.in_flight -= 1
+            if ok and latency <= self.latency_target:
+                # Grow by about one slot for every limit's worth of successes
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif ok is not None:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+            self.condition.notify_all()
+
+
+def is_upstream_failure(error):
+    # Outages, overload and timeouts count against an endpoint; bad requests do not
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(
+        error,
+        (
+            openai.APIConnectionError,
+            openai.RateLimitError,
+            openai.InternalServerError,
+            requests.ConnectionError,
+            requests.Timeout,
+            TimeoutError,
+        ),
+    ):
+        return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and (
+        response is None or response.status_code == 429 or response.status_code >= 500
+    )
+
+
+class UpstreamGuard:
+    def __init__(
+        self, name, breaker=None, limit=None, max_wait=1.0, fallback_size=1024
+    ):
+        self.name = name
+        self.breaker = breaker or CircuitBreaker()
+        self.limit = limit or AdaptiveLimit()
+        self.max_wait = max_wait
+        # Last good result per key, served while the endpoint is unhealthy
+        self.fallbacks = OrderedDict()
+        self.fallback_size = fallback_size
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def fallback(self, key):
+        with self.lock:
+            self.counts["short_circuited"] += 1
+            if key in self.fallbacks:
+                self.counts["fallbacks"] += 1
+                return self.fallbacks[key]
+        raise UpstreamUnavailable(f"{self.name} is unavailable")
+
+    def call(self, key, func, *args, **kwargs):
+        # Waiting for a slot is bounded, so a slow endpoint cannot pile up threads
+        if not self.limit.acquire(remaining_time(self.max_wait)):
+            return self.fallback(key)
+        if not self.breaker.allow():
+            self.limit.release()
+            return self.fallback(key)
+        start = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            failed = is_upstream_failure(e)
+            self.breaker.record(not failed)
+            self.limit.release(time.monotonic() - start, not failed)
+            with self.lock:
+                self.counts["failures" if failed else "successes"] += 1
+            raise
+        self.breaker.record(True)
+        self.limit.release(time.monotonic() - start, True)
+        with self.lock:
+            self.counts["successes"] += 1
+            self.fallbacks[key] = result
+            self.fallbacks.move_to_end(key)
+            if len(self.fallbacks) > self.fallback_size:
+                self.fallbacks.popitem(last=False)
+        return result
+
+
+upstream_guards = {
+    "chat.completions": UpstreamGuard("chat.completions"),
+    "moderations": UpstreamGuard("moderations"),
+    "aviation": UpstreamGuard("aviation", limit=AdaptiveLimit(latency_target=1.0)),
+}
+# The course's retry policy, limited to upstream failures: bad requests and an
+# open circuit stop further attempts
+upstream_retrying = Retrying(
+    wait=wait_random_exponential(min=5, max=40),
+    stop=stop_after_attempt(4),
+    retry=retry_if_exception(is_upstream_failure),
+    reraise=True,
+)
+
+
+def guarded_get_response(
+    messages,
+    model="gpt-3.5-turbo",
+    client=None,
+    guards=None,
+    retrying=None,
+    **params,
+):
+    # The guard and upstream_retrying own retries, so the SDK's are turned off
+    client = (client or get_openai_client()).with_options(max_retries=0)
+    key = json.dumps({"model": model, "messages": messages, **params}, sort_keys=True)
+
+    def create():
+        with telemetry.track("guarded_get_response"):
+            response = client.chat.completions.create(
+                model=model, messages=messages, **params
+            )
+        return response.choices[0].message.content
+
+    guard = (guards or upstream_guards)["chat.completions"]
+    return (retrying or upstream_retrying)(guard.call, key, create)
+
+
+def guarded_moderation(input, client=None, guards=None, retrying=None):
+    client = (client or get_openai_client()).with_options(max_retries=0)
+
+    def create():
+        with telemetry.track("guarded_moderation"):
+            return client.moderations.create(input=input)
+
+    key = json.dumps(input, sort_keys=True)
+    guard = (guards or upstream_guards)["moderations"]
+    return (retrying or upstream_retrying)(guard.call, key, create)
+
+
+def fetch_airport_info(airport_code, url="https://api.aviationapi.com/v1/airports"):
+    with telemetry.track("get_airport_info"):
+        response = get_http_session().get(
+            url, params={"apt": airport_code}, timeout=remaining_time(10)
+        )
+    response.raise_for_status()
+    return response.text
+
+
+def guarded_airport_info(
+    airport_code,
+    url="https://api.aviationapi.com/v1/airports",
+    guards=None,
+    retrying=None,
+):
+    key = (url, airport_code.upper())
+    guard = (guards or upstream_guards)["aviation"]
+    return (retrying or upstream_retrying)(
+        guard.call, key, fetch_airport_info, airport_code, url
+    )